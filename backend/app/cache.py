@@ -0,0 +1,163 @@
+"""In-process caches"""
+
+import secrets
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable, Optional
+
+
+class TTLCache:
+    """A bounded cache whose entries expire after `ttl` seconds.
+
+    When the cache is full, the least recently used entry is evicted.
+    Entries can carry tags, so that a write can invalidate every entry it
+    affects at once. Not thread safe, meant for use from the event loop.
+    """
+
+    def __init__(self, max_size: int, ttl: float, enabled: bool = True) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.enabled = enabled
+        # key -> (expires_at, value, tags), least recently used first
+        self._entries: OrderedDict = OrderedDict()
+        self._tags: dict[Hashable, set] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Returns the cached value, or the default if missing or expired."""
+        if not self.enabled:
+            return default
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                self.invalidate(key)
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        tags: Iterable[Hashable] = (),
+        ttl: Optional[float] = None,
+    ) -> None:
+        """Caches a value for `ttl` seconds, by default the ttl of the cache."""
+        if not self.enabled or self.max_size <= 0:
+            return
+        self.invalidate(key)
+        tags = frozenset(tags)
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._entries[key] = (expires_at, value, tags)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.max_size:
+            self.invalidate(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        """Removes a single entry."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate_tag(self, tag: Hashable) -> None:
+        """Removes every entry carrying the tag."""
+        for key in list(self._tags.get(tag, ())):
+            self.invalidate(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._tags.clear()
+
+    def stats(self) -> dict:
+        """Returns the size of the cache and its hit, miss and eviction counters."""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class VersionStamps:
+    """Cheap version stamps of resources, bumped whenever a resource changes.
+
+    A stamp gives an ETag and a Last-Modified time without reading the
+    resource. Stamps only see the writes of this process, so they also roll
+    over every `max_age` seconds; a write by another worker is noticed after
+    at most that long.
+
+    Only the most recently bumped `max_size` keys are tracked. An evicted
+    key hands its version and time down to a bucket picked by its hash, and
+    untracked keys take the stamp of their bucket. That never gives a key a
+    version older than its last one, and an eviction only changes the
+    stamps of the keys sharing the bucket.
+    """
+
+    def __init__(self, max_age: float, max_size: int = 10_000) -> None:
+        self.max_age = max_age
+        self.max_size = max_size
+        self.clear()
+
+    def _get(self, key: Hashable) -> tuple[int, float]:
+        entry = self._versions.get(key)
+        if entry is None:
+            entry = self._evicted[hash(key) % len(self._evicted)]
+        return entry
+
+    def bump(self, key: Hashable) -> None:
+        """Marks the resource as changed."""
+        self._counter += 1
+        self._versions.pop(key, None)
+        self._versions[key] = (self._counter, time.time())
+        while len(self._versions) > self.max_size:
+            evicted_key, (version, modified_at) = self._versions.popitem(last=False)
+            bucket = hash(evicted_key) % len(self._evicted)
+            bucket_version, bucket_modified_at = self._evicted[bucket]
+            self._evicted[bucket] = (
+                max(bucket_version, version),
+                max(bucket_modified_at, modified_at),
+            )
+
+    def modified_at(self, key: Hashable) -> float:
+        """Returns when this process last saw the resource change."""
+        return self._get(key)[1]
+
+    def stamp(self, key: Hashable, *variant: Hashable) -> tuple[str, float]:
+        """Returns the ETag and the last modification time of a resource.
+
+        The variant, e.g. the query parameters, is folded into the ETag.
+        """
+        version, modified_at = self._get(key)
+        now = time.time()
+        period = int(now // self.max_age)
+        modified_at = max(modified_at, period * self.max_age)
+        variant_hash = zlib.crc32(repr(variant).encode())
+        etag = f'W/"{self._epoch}-{period}-{version}-{variant_hash:x}"'
+        return etag, modified_at
+
+    def clear(self) -> None:
+        # a new epoch, so that no stamp from before is handed out again
+        self._epoch = secrets.token_hex(4)
+        self._counter = 0
+        self._versions: OrderedDict = OrderedDict()
+        # (version, modified_at) of the evicted keys, by bucket
+        self._evicted = [(0, 0.0)] * max(1, self.max_size)
@@ -1,5 +1,5 @@
 from functools import lru_cache  # Least Recently Used Cache
-from typing import Optional
+from typing import Literal, Optional
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -16,15 +16,88 @@ class GlobalConfig(BaseConfig):
 
     DATABASE_URL: Optional[str] = None
     DB_FORCE_ROLL_BACK: bool = False
+    # applies pending migrations when a worker starts; turn it off where the
+    # deployment runs `python -m app.migrate` instead
+    DB_BOOTSTRAP_SCHEMA: bool = True
+    # pragmas set on every SQLite connection; WAL lets readers and a writer
+    # work at once, busy_timeout makes writers wait for the lock
+    SQLITE_JOURNAL_MODE: Literal["DELETE", "TRUNCATE", "PERSIST", "WAL"] = "WAL"
+    SQLITE_SYNCHRONOUS: Literal["OFF", "NORMAL", "FULL", "EXTRA"] = "NORMAL"
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    SQLITE_CACHE_SIZE: int = -64 * 1024  # negative means KiB, so 64 MiB
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_FOREIGN_KEYS: bool = True
+    # optional read replica for the read routes of posts and comments
+    READ_DATABASE_URL: Optional[str] = None
+    # how long a changed post or feed is read from the primary instead,
+    # so that clients see their own writes despite the replica's lag
+    READ_REPLICA_MAX_LAG_SECONDS: float = 2.0
+    # connection pool of PostgreSQL; SQLite opens a connection per acquire
+    DB_POOL_MIN_SIZE: int = 1
+    DB_POOL_MAX_SIZE: int = 10
+    DB_POOL_ACQUIRE_TIMEOUT_SECONDS: float = 5.0
+    # connections are replaced after this long, and closed after being idle
+    DB_CONNECTION_MAX_LIFETIME_SECONDS: float = 3600.0
+    DB_CONNECTION_MAX_IDLE_SECONDS: float = 300.0
+    # PostgreSQL cancels statements running longer, 0 turns it off
+    DB_STATEMENT_TIMEOUT_SECONDS: float = 30.0
+    # compiled statements kept per database, and statements asyncpg keeps
+    # prepared per connection; 0 turns either off, e.g. behind pgbouncer
+    DB_STATEMENT_CACHE_SIZE: int = 500
+    DB_PREPARED_STATEMENT_CACHE_SIZE: int = 100
     SECRET_KEY: Optional[str] = None
     ALGORITHM: Optional[str] = None
     ACCESS_TOKEN_EXPIRE_MINUTES: Optional[int] = 30
+    REFRESH_TOKEN_EXPIRE_DAYS: int = 30
+    # bloom filter of revoked tokens, reloaded from the database this often,
+    # rereading the last ids in case they committed out of order, and rebuilt
+    # with the expired revocations deleted every REVOCATION_REBUILD_SECONDS
+    REVOCATION_BLOOM_BITS: int = 1 << 20
+    REVOCATION_BLOOM_HASHES: int = 7
+    REVOCATION_RELOAD_SECONDS: float = 30.0
+    REVOCATION_RELOAD_OVERLAP_IDS: int = 1000
+    REVOCATION_REBUILD_SECONDS: float = 3600.0
+    # access tokens carry the id and confirmed flag of the user, so that
+    # write routes take the user from the token instead of the database
+    STATELESS_AUTH: bool = False
     MAILGUN_API_KEY: Optional[str] = None
     MAILGUN_DOMAIN: Optional[str] = None
     BACKLBLAZE_B2_KEY_ID: Optional[str] = None
     BACKLBLAZE_B2_APPLICATION_KEY: Optional[str] = None
     BACKLBLAZE_B2_BUCKET_NAME: Optional[str] = None
     DEEPAI_API_KEY: Optional[str] = None
+    # in-process cache of GET /posts pages and GET /post/{post_id}
+    POST_CACHE_ENABLED: bool = True
+    POST_CACHE_MAX_SIZE: int = 1024
+    POST_CACHE_TTL_SECONDS: float = 5.0
+    # in-process cache of the users behind access tokens
+    USER_CACHE_ENABLED: bool = True
+    USER_CACHE_MAX_SIZE: int = 4096
+    USER_CACHE_TTL_SECONDS: float = 60.0
+    # in-process cache of verified JWT claims, each kept until its token expires
+    CLAIMS_CACHE_ENABLED: bool = True
+    CLAIMS_CACHE_MAX_SIZE: int = 4096
+    # ETags of posts roll over this often, to notice writes of other workers
+    ETAG_MAX_AGE_SECONDS: float = 30.0
+    # cost of new bcrypt hashes, see `python -m app.security calibrate`;
+    # older hashes are upgraded on login
+    BCRYPT_ROUNDS: int = 12
+    # token buckets per client IP and per email, and the most concurrent
+    # requests, admitted to /register and /token
+    AUTH_RATE_LIMIT_ENABLED: bool = True
+    AUTH_IP_RATE_PER_MINUTE: float = 30.0
+    AUTH_IP_BURST: int = 10
+    AUTH_EMAIL_RATE_PER_MINUTE: float = 10.0
+    AUTH_EMAIL_BURST: int = 5
+    AUTH_MAX_CONCURRENT: int = 32
+    # threads hashing and verifying passwords, and how many calls may wait
+    # for them before /register and /token answer 503
+    PASSWORD_HASH_WORKERS: int = 4
+    PASSWORD_HASH_MAX_PENDING: int = 64
+    # most items accepted by one request to the bulk endpoints
+    BULK_MAX_ITEMS: int = 500
+    # bearer token for /internal/metrics, which is turned off without one
+    INTERNAL_METRICS_TOKEN: Optional[str] = None
 
 
 class DevConfig(GlobalConfig):
@@ -41,6 +114,7 @@ class TestConfig(GlobalConfig):
     model_config = SettingsConfigDict(env_prefix="TEST_", extra="ignore")
     DATABASE_URL: str = "sqlite:///test.db"
     DB_FORCE_ROLL_BACK: bool = True
+    BCRYPT_ROUNDS: int = 4  # the lowest cost, keeps the tests fast
 
 
 class ProdConfig(GlobalConfig):
@@ -1,10 +1,23 @@
 """Database schema for tables"""
 
+import functools
+import math
+import sqlite3
+import time
+import weakref
+from typing import Any, Awaitable, Callable
+
 import databases
 import sqlalchemy
+from databases.backends import postgres, sqlite
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.compiler import Compiled
+from sqlalchemy.sql.ddl import DDLElement
 
 # Python runs modules on import
+from app.cache import TTLCache
 from app.config import config
+from app.metrics import Gauge, Histogram
 
 metadata = sqlalchemy.MetaData()
 
@@ -24,6 +37,11 @@ post_table = sqlalchemy.Table(
     sqlalchemy.Column("body", sqlalchemy.String),
     sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False),
     sqlalchemy.Column("image_url", sqlalchemy.String),
+    # denormalized number of likes, kept up to date by triggers on likes
+    sqlalchemy.Column("likes", sqlalchemy.Integer, nullable=False, server_default="0"),
+    # backs the most_likes sorting, which orders by likes and then id
+    sqlalchemy.Index("ix_posts_likes_id", "likes", "id"),
+    sqlalchemy.Index("ix_posts_user_id", "user_id"),
 )
 
 comment_table = sqlalchemy.Table(
@@ -33,6 +51,8 @@ comment_table = sqlalchemy.Table(
     sqlalchemy.Column("body", sqlalchemy.String),
     sqlalchemy.Column("post_id", sqlalchemy.ForeignKey("posts.id"), nullable=False),
     sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False),
+    # finds the comments of a post already in the order they are paged in
+    sqlalchemy.Index("ix_comments_post_id_id", "post_id", "id"),
 )
 
 like_table = sqlalchemy.Table(
@@ -41,18 +61,364 @@ like_table = sqlalchemy.Table(
     sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
     sqlalchemy.Column("post_id", sqlalchemy.ForeignKey("posts.id"), nullable=False),
     sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False),
+    # a user likes a post only once; also serves lookups by post_id
+    sqlalchemy.Index("ux_likes_post_id_user_id", "post_id", "user_id", unique=True),
+    sqlalchemy.Index("ix_likes_user_id", "user_id"),
+)
+
+# Revoked access and refresh tokens, by their jti claim. Rows are only
+# needed until the token would have expired anyway.
+revoked_token_table = sqlalchemy.Table(
+    "revoked_tokens",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("jti", sqlalchemy.String, nullable=False, unique=True),
+    # the exp claim of the token, in seconds since the epoch
+    sqlalchemy.Column("expires_at", sqlalchemy.Integer, nullable=False),
 )
 
-connect_args = {"check_same_thread": False} if "sqlite" in config.DATABASE_URL else {}
-engine = sqlalchemy.create_engine(
+# Triggers keep posts.likes in step with the likes table, so that liking and
+# unliking a post is a single statement. Created by the migrations.
+like_counter_triggers = {
+    "sqlite": [
+        "CREATE TRIGGER IF NOT EXISTS likes_count_insert AFTER INSERT ON likes"
+        " BEGIN UPDATE posts SET likes = likes + 1 WHERE id = NEW.post_id; END",
+        "CREATE TRIGGER IF NOT EXISTS likes_count_delete AFTER DELETE ON likes"
+        " BEGIN UPDATE posts SET likes = likes - 1 WHERE id = OLD.post_id; END",
+    ],
+    "postgresql": [
+        "CREATE OR REPLACE FUNCTION count_post_likes() RETURNS trigger AS $$"
+        " BEGIN"
+        " IF TG_OP = 'INSERT' THEN"
+        " UPDATE posts SET likes = likes + 1 WHERE id = NEW.post_id;"
+        " ELSE"
+        " UPDATE posts SET likes = likes - 1 WHERE id = OLD.post_id;"
+        " END IF;"
+        " RETURN NULL;"
+        " END; $$ LANGUAGE plpgsql",
+        "DROP TRIGGER IF EXISTS likes_count ON likes",
+        "CREATE TRIGGER likes_count AFTER INSERT OR DELETE ON likes"
+        " FOR EACH ROW EXECUTE PROCEDURE count_post_likes()",
+    ],
+}
+
+
+def sqlite_pragmas() -> list[str]:
+    """The pragmas every SQLite connection starts with, from the config."""
+    return [
+        f"PRAGMA journal_mode = {config.SQLITE_JOURNAL_MODE}",
+        f"PRAGMA synchronous = {config.SQLITE_SYNCHRONOUS}",
+        f"PRAGMA mmap_size = {int(config.SQLITE_MMAP_SIZE)}",
+        f"PRAGMA cache_size = {int(config.SQLITE_CACHE_SIZE)}",
+        f"PRAGMA busy_timeout = {int(config.SQLITE_BUSY_TIMEOUT_MS)}",
+        f"PRAGMA foreign_keys = {'ON' if config.SQLITE_FOREIGN_KEYS else 'OFF'}",
+    ]
+
+
+pool_acquire_wait = Histogram(
+    "db_pool_acquire_wait_seconds", "Time spent waiting for a database connection"
+)
+
+
+class PoolUsage:
+    """Counts the database connections in use and the acquires waiting for one."""
+
+    def __init__(self) -> None:
+        self.in_use = 0
+        self.waiting = 0
+
+    async def acquire(self, acquire: Callable[[], Awaitable]) -> Any:
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            connection = await acquire()
+        finally:
+            self.waiting -= 1
+            pool_acquire_wait.observe(time.perf_counter() - start)
+        self.in_use += 1
+        return connection
+
+    def released(self) -> None:
+        self.in_use -= 1
+
+
+pool_usage = PoolUsage()
+
+
+class StatementCache:
+    """Compiled statements of one dialect.
+
+    encode/databases compiles every query it runs. The cache key SQLAlchemy
+    derives from a statement leaves out its bound values, so statements
+    built the same way, e.g. the post by id for any id, share one compiled
+    form and only their values are extracted per query. Statements whose
+    SQL depends on their values, e.g. IN lists, are compiled every time.
+    """
+
+    def __init__(self, dialect, max_size: int) -> None:
+        self.dialect = dialect
+        self.compiled = TTLCache(max_size=max_size, ttl=math.inf)
+
+    def _compile(self, query) -> Compiled:
+        return query.compile(
+            dialect=self.dialect, compile_kwargs={"render_postcompile": True}
+        )
+
+    def compile(self, query) -> tuple[Compiled, dict]:
+        """Returns the compiled statement and its parameters."""
+        if isinstance(query, DDLElement):
+            return self._compile(query), {}
+        cache_key = query._generate_cache_key()
+        if cache_key is None or any(
+            bind.expanding or bind.literal_execute for bind in cache_key.bindparams
+        ):
+            compiled = self._compile(query)
+            return compiled, compiled.construct_params()
+        compiled = self.compiled.get(cache_key.key)
+        if compiled is None:
+            compiled = self._compile(query)
+            self.compiled.set(cache_key.key, compiled)
+        params = compiled.construct_params(extracted_parameters=cache_key.bindparams)
+        fresh = self._compile(query)
+        assert fresh.string == compiled.string, (fresh.string, compiled.string)
+        assert fresh.construct_params() == params, (fresh.construct_params(), params)
+        return compiled, params
+
+
+class SQLitePool(sqlite.SQLitePool):
+    """Opens SQLite connections with the pragmas from the config.
+
+    SQLite applies most pragmas, e.g. foreign keys, only to the connection
+    that asks for them.
+    """
+
+    async def acquire(self):
+        connection = await pool_usage.acquire(super().acquire)
+        for pragma in sqlite_pragmas():
+            await connection.execute(pragma)
+        return connection
+
+    async def release(self, connection) -> None:
+        await super().release(connection)
+        pool_usage.released()
+
+
+class SQLiteConnection(sqlite.SQLiteConnection):
+    """Compiles queries through the statement cache of its backend."""
+
+    def __init__(self, pool: SQLitePool, dialect, statements: StatementCache):
+        super().__init__(pool, dialect)
+        self._statements = statements
+
+    def _compile(self, query):
+        compiled, params = self._statements.compile(query)
+
+        execution_context = self._dialect.execution_ctx_cls()
+        execution_context.dialect = self._dialect
+
+        args = []
+        if not isinstance(query, DDLElement):
+            processors = compiled._bind_processors
+            for key in compiled.positiontup:
+                value = params[key]
+                args.append(processors[key](value) if key in processors else value)
+
+            execution_context.result_column_struct = (
+                compiled._result_columns,
+                compiled._ordered_columns,
+                compiled._textual_ordered_columns,
+                compiled._ad_hoc_textual,
+                compiled._loose_column_name_matching,
+            )
+        return compiled.string, args, sqlite.CompilationContext(execution_context)
+
+
+class SQLiteBackend(sqlite.SQLiteBackend):
+    def __init__(self, database_url, **options) -> None:
+        super().__init__(database_url, **options)
+        self._pool = SQLitePool(self._database_url, **self._options)
+        self.statements = StatementCache(self._dialect, config.DB_STATEMENT_CACHE_SIZE)
+
+    def connection(self) -> SQLiteConnection:
+        return SQLiteConnection(self._pool, self._dialect, self.statements)
+
+
+# when each PostgreSQL connection was opened, to retire it after its lifetime
+connection_opened_at: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+async def record_connection_opened(connection) -> None:
+    connection_opened_at[connection] = time.monotonic()
+
+
+class PostgresConnection(postgres.PostgresConnection):
+    """Waits a bounded time for a pooled connection and retires old ones.
+
+    Queries are compiled through the statement cache of the backend. The
+    SQL of a cached statement is the same text on every call, so asyncpg
+    prepares it once per connection and reuses the prepared statement.
+    """
+
+    def _compile(self, query):
+        compiled, params = self._database.statements.compile(query)
+        if isinstance(query, DDLElement):
+            return compiled.string, [], None
+
+        params = sorted(params.items())
+        mapping = {key: "$" + str(i) for i, (key, _) in enumerate(params, start=1)}
+        processors = compiled._bind_processors
+        args = [
+            processors[key](value) if key in processors else value
+            for key, value in params
+        ]
+        return compiled.string % mapping, args, compiled._result_columns
+
+    async def acquire(self) -> None:
+        assert self._connection is None, "Connection is already acquired"
+        assert self._database._pool is not None, "DatabaseBackend is not running"
+        self._connection = await pool_usage.acquire(
+            functools.partial(
+                self._database._pool.acquire,
+                timeout=config.DB_POOL_ACQUIRE_TIMEOUT_SECONDS,
+            )
+        )
+
+    async def release(self) -> None:
+        opened_at = connection_opened_at.get(self._connection._con)
+        if (
+            opened_at is not None
+            and time.monotonic() - opened_at > config.DB_CONNECTION_MAX_LIFETIME_SECONDS
+        ):
+            # the pool replaces a closed connection with a new one
+            await self._connection.close()
+        await super().release()
+        pool_usage.released()
+
+
+class PostgresBackend(postgres.PostgresBackend):
+    def __init__(self, database_url, **options) -> None:
+        super().__init__(database_url, **options)
+        self.statements = StatementCache(self._dialect, config.DB_STATEMENT_CACHE_SIZE)
+
+    def connection(self) -> PostgresConnection:
+        return PostgresConnection(self, self._dialect)
+
+    def idle_connections(self) -> int:
+        return self._pool.get_idle_size() if self._pool is not None else 0
+
+
+class Database(databases.Database):
+    SUPPORTED_BACKENDS = {
+        **databases.Database.SUPPORTED_BACKENDS,
+        "postgresql": "app.database:PostgresBackend",
+        "postgres": "app.database:PostgresBackend",
+        "sqlite": "app.database:SQLiteBackend",
+    }
+
+
+def pool_options(url: str) -> dict:
+    """Options of the asyncpg connection pool, none for SQLite."""
+    if "postgres" not in url:
+        return {}
+    options = {
+        "min_size": config.DB_POOL_MIN_SIZE,
+        "max_size": config.DB_POOL_MAX_SIZE,
+        "max_inactive_connection_lifetime": config.DB_CONNECTION_MAX_IDLE_SECONDS,
+        "init": record_connection_opened,
+        "statement_cache_size": config.DB_PREPARED_STATEMENT_CACHE_SIZE,
+    }
+    if config.DB_STATEMENT_TIMEOUT_SECONDS:
+        timeout_ms = int(config.DB_STATEMENT_TIMEOUT_SECONDS * 1000)
+        options["server_settings"] = {"statement_timeout": str(timeout_ms)}
+    return options
+
+
+database = Database(
     config.DATABASE_URL,
-    connect_args=connect_args,
-    # echo=True for debugging
+    force_rollback=config.DB_FORCE_ROLL_BACK,
+    **pool_options(config.DATABASE_URL),
+)
+
+# Read only replica, the primary itself if no replica is configured.
+read_database = (
+    Database(config.READ_DATABASE_URL, **pool_options(config.READ_DATABASE_URL))
+    if config.READ_DATABASE_URL
+    else database
 )
 
-metadata.create_all(engine)
 
-db_args = {"min_size": 1, "max_size": 3} if "postgres" in config.DATABASE_URL else {}
-database = databases.Database(
-    config.DATABASE_URL, force_rollback=config.DB_FORCE_ROLL_BACK, **db_args
+def idle_connections() -> int:
+    backend = database._backend
+    return backend.idle_connections() if isinstance(backend, PostgresBackend) else 0
+
+
+Gauge("db_pool_in_use", "Database connections in use", lambda: pool_usage.in_use)
+Gauge("db_pool_idle", "Open database connections not in use", idle_connections)
+Gauge(
+    "db_pool_waiting",
+    "Requests waiting for a database connection",
+    lambda: pool_usage.waiting,
 )
+
+
+def is_postgres(db: databases.Database) -> bool:
+    """Tells PostgreSQL apart from SQLite, for the few dialect specific queries."""
+    return db.url.dialect.startswith("postgres")
+
+
+def is_foreign_key_violation(error: Exception) -> bool:
+    """Tells if a statement failed on a foreign key, on SQLite and PostgreSQL."""
+    if isinstance(error, sqlite3.IntegrityError):
+        return "FOREIGN KEY constraint failed" in str(error)
+    # asyncpg reports the SQLSTATE of foreign_key_violation
+    return getattr(error, "sqlstate", None) == "23503"
+
+
+def is_unique_violation(error: Exception) -> bool:
+    """Tells if a statement failed on a unique constraint, on SQLite and PostgreSQL."""
+    if isinstance(error, sqlite3.IntegrityError):
+        return "UNIQUE constraint failed" in str(error)
+    # asyncpg reports the SQLSTATE of unique_violation
+    return getattr(error, "sqlstate", None) == "23505"
+
+
+async def insert_returning_ids(
+    db: databases.Database, table: sqlalchemy.Table, rows: list[dict]
+) -> list[int]:
+    """Inserts the rows with a single statement and returns their ids in order."""
+    query = table.insert().values(rows)
+    if is_postgres(db):
+        return [row.id for row in await db.fetch_all(query.returning(table.c.id))]
+    # SQLite hands out consecutive rowids to the rows of a single statement
+    last_id = await db.execute(query)
+    return list(range(last_id - len(rows) + 1, last_id + 1))
+
+
+def insert_likes_query(rows: list[dict], postgres: bool):
+    """Inserts likes, skipping those a user already gave.
+
+    Returns id and post_id of the likes that were actually inserted.
+    """
+    if postgres:
+        return (
+            postgresql.insert(like_table)
+            .values(rows)
+            .on_conflict_do_nothing(
+                index_elements=[like_table.c.post_id, like_table.c.user_id]
+            )
+            .returning(like_table.c.id, like_table.c.post_id)
+        )
+    # The SQLite dialect of SQLAlchemy 1.4 cannot render RETURNING yet.
+    values = ", ".join(f"(:post_id_{i}, :user_id_{i})" for i in range(len(rows)))
+    params = {}
+    for i, row in enumerate(rows):
+        params[f"post_id_{i}"] = row["post_id"]
+        params[f"user_id_{i}"] = row["user_id"]
+    return (
+        sqlalchemy.text(
+            f"INSERT INTO likes (post_id, user_id) VALUES {values}"
+            " ON CONFLICT (post_id, user_id) DO NOTHING RETURNING id, post_id"
+        )
+        .bindparams(**params)
+        .columns(id=sqlalchemy.Integer, post_id=sqlalchemy.Integer)
+    )
@@ -1,10 +1,15 @@
+import asyncio
 import logging
 from contextlib import asynccontextmanager
 
-from app.database import database
+from app.config import config
+from app.database import database, read_database
 from app.logging_config import configure_logging
+from app.migrate import upgrade
+from app.revocation import revocation_list
 
 # from app.routers.docs import router as docs_router
+from app.routers.internal import router as internal_router
 from app.routers.post import router as post_router
 from app.routers.upload import router as upload_router
 from app.routers.user import router as user_router
@@ -20,7 +25,10 @@ logger = logging.getLogger(__name__)
 # context manager does setup and tear down
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """Awaits the database when the app starts and disconnects when it stops."""
+    """Awaits the database when the app starts and disconnects when it stops.
+
+    Also brings the schema up to date, unless DB_BOOTSTRAP_SCHEMA is off.
+    """
     configure_logging()
     # logger.info("Hello world.")
     # logger.info("Hello world.")
@@ -28,7 +36,22 @@ async def lifespan(app: FastAPI):
     # logger.info("Hello world.")
     # logger.info("Hello world.")
     await database.connect()
+    if config.DB_BOOTSTRAP_SCHEMA:
+        await upgrade(database)
+    if read_database is not database:
+        await read_database.connect()
+    await revocation_list.rebuild(database)
+    reloader = asyncio.create_task(
+        revocation_list.reload_periodically(
+            database,
+            config.REVOCATION_RELOAD_SECONDS,
+            config.REVOCATION_REBUILD_SECONDS,
+        )
+    )
     yield  # this is where the FastAPI runs - when its done, it comes back here and closes down
+    reloader.cancel()
+    if read_database is not database:
+        await read_database.disconnect()
     await database.disconnect()
 
 
@@ -41,6 +64,7 @@ app.add_middleware(CorrelationIdMiddleware)
 app.include_router(post_router)
 app.include_router(upload_router)
 app.include_router(user_router)
+app.include_router(internal_router)
 
 # # Define the OAuth2 security scheme
 # oauth2_scheme = SecurityScheme(
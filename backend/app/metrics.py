@@ -0,0 +1,84 @@
+"""In-process metrics
+
+Metrics register themselves by name when they are created, `collect()`
+returns a snapshot of all of them. Updates are plain attribute writes,
+callers in worker threads must hand them over to the event loop.
+"""
+
+import logging
+import math
+from typing import Callable, Sequence
+
+logger = logging.getLogger(__name__)
+
+# in seconds, from a fast cache hit to a slow bcrypt round
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+registry: dict[str, "Counter | Gauge | Histogram"] = {}
+
+
+class Counter:
+    """Counts events."""
+
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        self.value = 0
+        registry[name] = self
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def snapshot(self) -> dict:
+        return {"type": "counter", "value": self.value}
+
+
+class Gauge:
+    """Reports a current value, read when the metrics are collected."""
+
+    def __init__(self, name: str, description: str, read: Callable[[], float]) -> None:
+        self.name = name
+        self.description = description
+        self.read = read
+        registry[name] = self
+
+    def snapshot(self) -> dict:
+        return {"type": "gauge", "value": self.read()}
+
+
+class Histogram:
+    """Counts observations in cumulative buckets, like a Prometheus histogram."""
+
+    def __init__(
+        self, name: str, description: str, buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> None:
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        registry[name] = self
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def snapshot(self) -> dict:
+        return {
+            "type": "histogram",
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {
+                "+Inf" if math.isinf(bound) else str(bound): count
+                for bound, count in zip(self.buckets, self.counts)
+            },
+        }
+
+
+def collect() -> dict:
+    """Returns the current values of all metrics."""
+    return {name: metric.snapshot() for name, metric in registry.items()}
@@ -0,0 +1,198 @@
+"""Versioned schema migrations
+
+Every migration runs once, in order, inside its own transaction. The
+version of the last applied migration is recorded in the schema_version
+table. Works on the SQLite and the PostgreSQL databases we deploy with:
+
+    python -m app.migrate            applies all pending migrations
+    python -m app.migrate current    prints the current schema version
+
+The migrations build on the tables in app.database, so they always create
+the current tables and skip whatever already exists.
+"""
+
+import argparse
+import asyncio
+import datetime
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+import sqlalchemy
+from app.database import (
+    comment_table,
+    database,
+    is_postgres,
+    like_counter_triggers,
+    like_table,
+    metadata,
+    post_table,
+    revoked_token_table,
+)
+from app.logging_config import configure_logging
+from app.reconcile_likes import reconcile_like_counts
+from databases import Database
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.schema import CreateIndex, CreateTable, DDLElement
+
+logger = logging.getLogger(__name__)
+
+schema_metadata = sqlalchemy.MetaData()
+
+schema_version_table = sqlalchemy.Table(
+    "schema_version",
+    schema_metadata,
+    sqlalchemy.Column("version", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("description", sqlalchemy.String),
+    sqlalchemy.Column("applied_at", sqlalchemy.DateTime),
+)
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    apply: Callable[[Database], Awaitable[None]]
+
+
+async def column_exists(db: Database, table: str, column: str) -> bool:
+    if is_postgres(db):
+        query = (
+            "SELECT 1 FROM information_schema.columns"
+            " WHERE table_name = :table AND column_name = :column"
+        )
+    else:
+        query = "SELECT 1 FROM pragma_table_info(:table) WHERE name = :column"
+    return await db.fetch_one(query, {"table": table, "column": column}) is not None
+
+
+async def execute_ddl(db: Database, element: DDLElement) -> None:
+    # compiled up front, as databases passes options the SQLite DDL compiler rejects
+    dialect = postgresql.dialect() if is_postgres(db) else sqlite.dialect()
+    await db.execute(str(element.compile(dialect=dialect)))
+
+
+async def create_index(db: Database, index: sqlalchemy.Index) -> None:
+    await execute_ddl(db, CreateIndex(index, if_not_exists=True))
+
+
+def index_of(table: sqlalchemy.Table, name: str) -> sqlalchemy.Index:
+    return next(index for index in table.indexes if index.name == name)
+
+
+async def create_tables(db: Database) -> None:
+    for table in metadata.sorted_tables:
+        await execute_ddl(db, CreateTable(table, if_not_exists=True))
+
+
+async def add_post_like_counter(db: Database) -> None:
+    if not await column_exists(db, "posts", "likes"):
+        await db.execute(
+            "ALTER TABLE posts ADD COLUMN likes INTEGER NOT NULL DEFAULT 0"
+        )
+    await reconcile_like_counts(db)
+
+
+async def add_secondary_indexes(db: Database) -> None:
+    await create_index(db, index_of(post_table, "ix_posts_likes_id"))
+    await create_index(db, index_of(post_table, "ix_posts_user_id"))
+    await create_index(db, index_of(comment_table, "ix_comments_post_id_id"))
+    await create_index(db, index_of(like_table, "ix_likes_user_id"))
+
+
+async def make_likes_unique(db: Database) -> None:
+    # keeps the first like of every user on a post and drops the repeats
+    first_likes = sqlalchemy.select(sqlalchemy.func.min(like_table.c.id)).group_by(
+        like_table.c.post_id, like_table.c.user_id
+    )
+    await db.execute(like_table.delete().where(like_table.c.id.not_in(first_likes)))
+    await create_index(db, index_of(like_table, "ux_likes_post_id_user_id"))
+    await reconcile_like_counts(db)
+
+
+async def count_likes_with_triggers(db: Database) -> None:
+    dialect = "postgresql" if is_postgres(db) else "sqlite"
+    for statement in like_counter_triggers[dialect]:
+        await db.execute(statement)
+    await reconcile_like_counts(db)
+
+
+async def add_revoked_tokens(db: Database) -> None:
+    await execute_ddl(db, CreateTable(revoked_token_table, if_not_exists=True))
+
+
+MIGRATIONS = [
+    Migration(1, "Create tables", create_tables),
+    Migration(2, "Add like counter to posts", add_post_like_counter),
+    Migration(3, "Add secondary indexes", add_secondary_indexes),
+    Migration(4, "Allow one like per user and post", make_likes_unique),
+    Migration(5, "Count likes with triggers", count_likes_with_triggers),
+    Migration(6, "Add revoked tokens", add_revoked_tokens),
+]
+
+
+async def current_version(db: Database) -> int:
+    """Returns the version of the last applied migration, 0 for a new database."""
+    await execute_ddl(db, CreateTable(schema_version_table, if_not_exists=True))
+    query = sqlalchemy.select(sqlalchemy.func.max(schema_version_table.c.version))
+    return await db.fetch_val(query) or 0
+
+
+# any number, only has to be the same for every worker
+MIGRATION_LOCK_ID = 4_242_001
+
+
+async def upgrade(db: Database) -> int:
+    """Applies all pending migrations and returns the new schema version.
+
+    On PostgreSQL, workers starting at the same time take turns through an
+    advisory lock, so that every migration is applied once.
+    """
+    if not is_postgres(db):
+        return await apply_pending_migrations(db)
+    async with db.connection() as connection:
+        await connection.execute(f"SELECT pg_advisory_lock({MIGRATION_LOCK_ID})")
+        try:
+            return await apply_pending_migrations(db)
+        finally:
+            await connection.execute(f"SELECT pg_advisory_unlock({MIGRATION_LOCK_ID})")
+
+
+async def apply_pending_migrations(db: Database) -> int:
+    version = await current_version(db)
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        logger.info(f"Applying migration {migration.version}: {migration.description}")
+        async with db.transaction():
+            await migration.apply(db)
+            await db.execute(
+                schema_version_table.insert().values(
+                    version=migration.version,
+                    description=migration.description,
+                    applied_at=datetime.datetime.now(datetime.timezone.utc),
+                )
+            )
+        version = migration.version
+    logger.info(f"Schema is at version {version}")
+    return version
+
+
+async def main(command: str):
+    configure_logging()
+    await database.connect()
+    try:
+        if command == "current":
+            print(await current_version(database))
+        else:
+            await upgrade(database)
+    finally:
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "command", nargs="?", default="upgrade", choices=["upgrade", "current"]
+    )
+    asyncio.run(main(parser.parse_args().command))
@@ -44,6 +44,8 @@ class UserPostWithComments(BaseModel):
 
     post: UserPostWithLikes
     comments: list[Comment]
+    # continues the comments at GET /post/{post_id}/comment, if there are more
+    comments_cursor: Optional[str] = None
 
 
 class PostLikeIn(BaseModel):
@@ -55,5 +57,15 @@ class PostLikeIn(BaseModel):
 class PostLike(PostLikeIn):
     """This is the PostLike model"""
 
-    id: int
+    # None, if the user had already liked the post
+    id: Optional[int] = None
     user_id: int
+
+
+class BulkItemResult(BaseModel):
+    """This is the BulkItemResult model, the outcome of one item of a bulk write"""
+
+    index: int
+    status_code: int
+    id: Optional[int] = None
+    detail: Optional[str] = None
@@ -12,3 +12,9 @@ class UserIn(User):
     """User model in"""
 
     password: str
+
+
+class RefreshTokenIn(BaseModel):
+    """Refresh token model in"""
+
+    refresh_token: str
@@ -0,0 +1,51 @@
+"""Helpers for keyset (cursor) pagination"""
+
+import base64
+import binascii
+import json
+import logging
+
+from fastapi import HTTPException, status
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Clients find the cursor for the next page in this response header.
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(kind: str, **position) -> str:
+    """Encodes the position of the last row of a page as an opaque cursor."""
+    payload = json.dumps({"k": kind, **position}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def invalid_cursor_exception() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+    )
+
+
+def decode_cursor(cursor: str, kind: str, **fields: type) -> dict:
+    """Decodes a cursor issued for the same kind of listing.
+
+    `fields` maps every expected position key to the type it is coerced to.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if position.get("k") != kind:
+            logger.debug("Cursor was issued for another listing")
+            raise invalid_cursor_exception()
+        return {name: cast(position[name]) for name, cast in fields.items()}
+    except (
+        binascii.Error,
+        UnicodeDecodeError,
+        ValueError,
+        AttributeError,
+        KeyError,
+        TypeError,
+    ) as e:
+        raise invalid_cursor_exception() from e
@@ -0,0 +1,125 @@
+"""Admission control for the CPU heavy auth routes
+
+/register and /token hash passwords with bcrypt, which is slow on purpose.
+Before any hashing, a request has to get a token from the bucket of its
+client IP and from the bucket of the email it names, and find a free slot
+under the global concurrency cap. Otherwise it is turned away with a 429.
+The buckets are only touched between awaits, a plain dict is enough.
+"""
+
+import logging
+import math
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Hashable, Optional
+
+from app.config import config
+from app.metrics import Counter
+from fastapi import HTTPException, status
+
+logger = logging.getLogger(__name__)
+
+auth_requests_rejected = Counter(
+    "auth_requests_rejected_total", "Auth requests turned away by the rate limiter"
+)
+
+
+class TokenBuckets:
+    """Token buckets by key, refilled at `rate` tokens per second up to `burst`.
+
+    Only the most recently used `max_size` buckets are kept. A dropped bucket
+    starts out full again, which only matters for clients idle long enough
+    to have refilled anyway.
+    """
+
+    def __init__(self, rate: float, burst: int, max_size: int = 100_000) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        # key -> (tokens, updated_at), least recently used first
+        self._buckets: OrderedDict = OrderedDict()
+
+    def take(self, key: Hashable) -> Optional[float]:
+        """Takes a token, or returns the seconds until the next one is available."""
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        if tokens >= 1:
+            self._buckets[key] = (tokens - 1, now)
+            retry_after = None
+        else:
+            self._buckets[key] = (tokens, now)
+            retry_after = (1 - tokens) / self.rate
+        while len(self._buckets) > self.max_size:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+    def clear(self) -> None:
+        self._buckets.clear()
+
+
+def too_many_requests_exception(retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many requests, please try again later.",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+class AuthLimiter:
+    """Per IP and per email token buckets plus a global concurrency cap."""
+
+    def __init__(
+        self,
+        ip_rate: float,
+        ip_burst: int,
+        email_rate: float,
+        email_burst: int,
+        max_concurrent: int,
+        enabled: bool = True,
+    ) -> None:
+        self.by_ip = TokenBuckets(ip_rate, ip_burst)
+        self.by_email = TokenBuckets(email_rate, email_burst)
+        self.max_concurrent = max_concurrent
+        self.enabled = enabled
+        self.in_flight = 0
+
+    @contextmanager
+    def admit(self, ip: Optional[str], email: str):
+        """Holds a slot for the request, or raises a 429 right away."""
+        if not self.enabled:
+            yield
+            return
+        if self.in_flight >= self.max_concurrent:
+            auth_requests_rejected.inc()
+            logger.warning("Too many concurrent auth requests")
+            raise too_many_requests_exception(1)
+        for buckets, key in [
+            (self.by_ip, ip or "unknown"),
+            (self.by_email, email.strip().lower()),
+        ]:
+            retry_after = buckets.take(key)
+            if retry_after is not None:
+                auth_requests_rejected.inc()
+                logger.warning("Auth request rate limited", extra={"email": email})
+                raise too_many_requests_exception(retry_after)
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    def clear(self) -> None:
+        self.by_ip.clear()
+        self.by_email.clear()
+
+
+auth_limiter = AuthLimiter(
+    ip_rate=config.AUTH_IP_RATE_PER_MINUTE / 60,
+    ip_burst=config.AUTH_IP_BURST,
+    email_rate=config.AUTH_EMAIL_RATE_PER_MINUTE / 60,
+    email_burst=config.AUTH_EMAIL_BURST,
+    max_concurrent=config.AUTH_MAX_CONCURRENT,
+    enabled=config.AUTH_RATE_LIMIT_ENABLED,
+)
@@ -0,0 +1,54 @@
+"""Recounts the likes of every post and fixes drifted counters.
+
+Run once after adding the posts.likes column and whenever the counters are
+suspected to be off:
+
+    python -m app.reconcile_likes
+"""
+
+import asyncio
+import logging
+
+import sqlalchemy
+from app.database import database, like_table, post_table
+from app.logging_config import configure_logging
+from databases import Database
+
+logger = logging.getLogger(__name__)
+
+
+async def reconcile_like_counts(database: Database) -> int:
+    """Sets posts.likes to the real number of likes and returns the fixed posts."""
+    counted_likes = (
+        sqlalchemy.select(sqlalchemy.func.count(like_table.c.id))
+        .where(like_table.c.post_id == post_table.c.id)
+        .scalar_subquery()
+    )
+    drifted = sqlalchemy.select(post_table.c.id).where(
+        post_table.c.likes != counted_likes
+    )
+    async with database.transaction():
+        post_ids = [row.id for row in await database.fetch_all(drifted)]
+        if post_ids:
+            query = (
+                post_table.update()
+                .where(post_table.c.id.in_(post_ids))
+                .values(likes=counted_likes)
+            )
+            logger.debug(query)
+            await database.execute(query)
+    logger.info(f"Reconciled like counters of {len(post_ids)} posts")
+    return len(post_ids)
+
+
+async def main():
+    configure_logging()
+    await database.connect()
+    try:
+        await reconcile_like_counts(database)
+    finally:
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
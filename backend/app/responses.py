@@ -0,0 +1,94 @@
+"""Response helpers shared by the routers"""
+
+import functools
+from email.utils import formatdate, parsedate_to_datetime
+from typing import AsyncIterator, Iterable, Mapping, Optional
+
+import orjson
+from fastapi import Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# documents the streamed alternative of an endpoint in the OpenAPI schema
+NDJSON_RESPONSES = {
+    200: {
+        "content": {NDJSON_MEDIA_TYPE: {}},
+        "description": "One JSON object per line, if streaming was requested.",
+    }
+}
+
+
+@functools.cache
+def field_names(model: type[BaseModel]) -> tuple[str, ...]:
+    return tuple(model.model_fields)
+
+
+def project(row: Mapping, model: type[BaseModel]) -> dict:
+    """Picks the fields of the model out of a database row or a dict."""
+    row = getattr(row, "_mapping", row)
+    return {name: row[name] for name in field_names(model)}
+
+
+def rows_response(
+    rows: Iterable[Mapping], model: type[BaseModel], headers: Optional[dict] = None
+) -> ORJSONResponse:
+    """Serializes database rows as a JSON list, without building models.
+
+    The rows come from our own tables, whose columns match the model, so
+    validating them again only costs time. The route keeps declaring the
+    model as its response_model, which still documents the response.
+    """
+    return ORJSONResponse([project(row, model) for row in rows], headers=headers)
+
+
+def wants_ndjson(request: Request, stream: bool) -> bool:
+    """Clients ask for a stream with ?stream=true or by accepting NDJSON."""
+    return stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def ndjson_response(
+    rows: AsyncIterator, model: type[BaseModel], headers: Optional[dict] = None
+) -> StreamingResponse:
+    """Streams database rows as newline delimited JSON.
+
+    Every row is serialized and sent as soon as the database hands it over,
+    so the whole result set is never held in memory.
+    """
+
+    async def lines():
+        async for row in rows:
+            yield orjson.dumps(project(row, model)) + b"\n"
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+
+
+def validator_headers(etag: str, last_modified: float) -> dict:
+    return {"ETag": etag, "Last-Modified": formatdate(last_modified, usegmt=True)}
+
+
+def is_not_modified(request: Request, etag: str, last_modified: float) -> bool:
+    """Tells if the client already holds the current version of a resource.
+
+    If-None-Match takes precedence over If-Modified-Since, as in RFC 9110.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        # weak comparison, the W/ prefix does not matter
+        held = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return etag.removeprefix("W/") in held
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(last_modified) <= since
+    return False
+
+
+def not_modified_response(headers: dict) -> Response:
+    return Response(status_code=304, headers=headers)
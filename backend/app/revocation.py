@@ -0,0 +1,164 @@
+"""Revoked tokens
+
+Every revoked token is stored in the revoked_tokens table and added to a
+bloom filter in memory. Checking a token that was never revoked, which is
+almost every token, only asks the bloom filter. Only the rare positives are
+confirmed by a query, as a bloom filter has false positives.
+
+Revocations by other workers reach the bloom filter with the next periodic
+reload, so they take effect after at most REVOCATION_RELOAD_SECONDS. Ids are
+handed out before commit, so a reload rereads the last
+REVOCATION_RELOAD_OVERLAP_IDS ids, to pick up rows that committed late. Every
+REVOCATION_REBUILD_SECONDS, expired rows are deleted and the bloom filter is
+rebuilt from scratch.
+"""
+
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Optional
+
+import sqlalchemy
+from app.config import config
+from app.database import is_unique_violation, revoked_token_table
+from databases import Database
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """A set of strings that can tell for sure that a string is not in it."""
+
+    def __init__(self, bits: int, hashes: int) -> None:
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray((bits + 7) // 8)
+
+    def _positions(self, item: str):
+        # double hashing, derives all positions from two 64-bit hashes
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self._array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self._array[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+class RevocationList:
+    """The revoked tokens, by jti."""
+
+    def __init__(self, bits: int, hashes: int) -> None:
+        self.bits = bits
+        self.hashes = hashes
+        self.clear()
+
+    def clear(self) -> None:
+        self._bloom = BloomFilter(self.bits, self.hashes)
+        # id of the last row of revoked_tokens in the bloom filter
+        self._last_id = 0
+        # tokens revoked by this process while a rebuild is reading
+        self._revoked_during_rebuild: Optional[list[str]] = None
+
+    async def _fetch(self, db: Database, after_id: int):
+        query = (
+            sqlalchemy.select(revoked_token_table.c.id, revoked_token_table.c.jti)
+            .where(revoked_token_table.c.id > after_id)
+            .where(revoked_token_table.c.expires_at > int(time.time()))
+            .order_by(revoked_token_table.c.id)
+        )
+        return await db.fetch_all(query)
+
+    async def load(self, db: Database) -> int:
+        """Adds the tokens revoked since the last load and returns the rows read.
+
+        The last ids loaded before are read again, as rows with lower ids
+        may have committed after the last load.
+        """
+        after_id = max(0, self._last_id - config.REVOCATION_RELOAD_OVERLAP_IDS)
+        rows = await self._fetch(db, after_id)
+        for row in rows:
+            self._bloom.add(row.jti)
+            self._last_id = max(self._last_id, row.id)
+        return len(rows)
+
+    async def rebuild(self, db: Database) -> None:
+        """Loads the bloom filter from scratch, leaving out expired tokens.
+
+        The old filter is used until the new one is complete.
+        """
+        self._revoked_during_rebuild = []
+        try:
+            rows = await self._fetch(db, 0)
+            bloom = BloomFilter(self.bits, self.hashes)
+            for row in rows:
+                bloom.add(row.jti)
+            for jti in self._revoked_during_rebuild:
+                bloom.add(jti)
+        finally:
+            self._revoked_during_rebuild = None
+        self._bloom = bloom
+        self._last_id = max((row.id for row in rows), default=0)
+        logger.info(f"Loaded {len(rows)} revoked tokens")
+
+    async def prune(self, db: Database) -> None:
+        """Deletes the revocations of tokens that expired anyway."""
+        query = revoked_token_table.delete().where(
+            revoked_token_table.c.expires_at <= int(time.time())
+        )
+        await db.execute(query)
+
+    async def reload_periodically(
+        self, db: Database, interval: float, rebuild_interval: float
+    ) -> None:
+        next_rebuild = time.monotonic() + rebuild_interval
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if time.monotonic() < next_rebuild:
+                    await self.load(db)
+                    continue
+                await self.prune(db)
+                await self.rebuild(db)
+                next_rebuild = time.monotonic() + rebuild_interval
+            except Exception:
+                logger.exception("Reloading the revoked tokens failed")
+
+    def _add(self, jti: str) -> None:
+        self._bloom.add(jti)
+        if self._revoked_during_rebuild is not None:
+            self._revoked_during_rebuild.append(jti)
+
+    async def revoke(self, db: Database, jti: str, expires_at: int) -> bool:
+        """Revokes a token, returns False if it was revoked already."""
+        query = revoked_token_table.insert().values(jti=jti, expires_at=expires_at)
+        try:
+            await db.execute(query)
+        except Exception as e:
+            if not is_unique_violation(e):
+                raise
+            self._add(jti)
+            return False
+        self._add(jti)
+        return True
+
+    async def is_revoked(self, db: Database, jti: str) -> bool:
+        if jti not in self._bloom:
+            return False
+        query = sqlalchemy.select(revoked_token_table.c.id).where(
+            revoked_token_table.c.jti == jti
+        )
+        return await db.fetch_one(query) is not None
+
+
+revocation_list = RevocationList(
+    bits=config.REVOCATION_BLOOM_BITS, hashes=config.REVOCATION_BLOOM_HASHES
+)
@@ -0,0 +1,45 @@
+import logging
+import secrets
+from typing import Annotated, Optional
+
+from app.config import config
+from app.metrics import collect
+from app.routers.post import post_cache
+from app.security import claims_cache, user_cache
+from fastapi import APIRouter, Depends, Header, HTTPException, status
+
+logger = logging.getLogger(__name__)
+
+
+async def require_internal_token(
+    authorization: Annotated[Optional[str], Header()] = None
+):
+    """Only lets through requests with the INTERNAL_METRICS_TOKEN as bearer token."""
+    if not config.INTERNAL_METRICS_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    expected = f"Bearer {config.INTERNAL_METRICS_TOKEN}"
+    if not secrets.compare_digest((authorization or "").encode(), expected.encode()):
+        logger.warning("Rejected a request to the internal paths")
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized"
+        )
+
+
+router = APIRouter(
+    prefix="/internal",
+    include_in_schema=False,
+    dependencies=[Depends(require_internal_token)],
+)
+
+
+@router.get("/metrics")
+async def get_metrics():
+    """This is the metrics path of the API, for monitoring only"""
+    return {
+        "metrics": collect(),
+        "caches": {
+            "posts": post_cache.stats(),
+            "users": user_cache.stats(),
+            "claims": claims_cache.stats(),
+        },
+    }
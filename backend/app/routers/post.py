@@ -1,10 +1,27 @@
 import logging
+import time
+from contextlib import contextmanager
 from enum import Enum
-from typing import Annotated
+from operator import itemgetter
+from typing import Annotated, Optional
 
+import orjson
 import sqlalchemy
-from app.database import comment_table, database, like_table, post_table
+from app.cache import TTLCache, VersionStamps
+from app.config import config
+from app.database import (
+    comment_table,
+    database,
+    insert_likes_query,
+    insert_returning_ids,
+    is_foreign_key_violation,
+    is_postgres,
+    like_table,
+    post_table,
+    read_database,
+)
 from app.models.post import (
+    BulkItemResult,
     Comment,
     CommentIn,
     PostLike,
@@ -15,10 +32,38 @@ from app.models.post import (
     UserPostWithLikes,
 )
 from app.models.user import User
-from app.security import get_current_user
+from app.pagination import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    NEXT_CURSOR_HEADER,
+    decode_cursor,
+    encode_cursor,
+)
+from app.responses import (
+    NDJSON_RESPONSES,
+    is_not_modified,
+    ndjson_response,
+    not_modified_response,
+    project,
+    rows_response,
+    validator_headers,
+    wants_ndjson,
+)
+from app.security import get_token_user
 from app.tasks import generate_and_add_to_post
-from fastapi import APIRouter, BackgroundTasks, Depends, Request
+from databases import Database
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Body,
+    Depends,
+    Query,
+    Request,
+    Response,
+)
 from fastapi.exceptions import HTTPException
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 
 router = APIRouter()
 
@@ -31,34 +76,80 @@ logger = logging.getLogger(__name__)
 # return {"message": "Hello World"}
 
 
-select_post_and_likes = (
-    (
-        sqlalchemy.select(
-            post_table,
-            sqlalchemy.func.count(like_table.c.id).label("likes"),
-        )
-    )
-    .select_from(post_table.outerjoin(like_table))  # joins post_table with like_tables
-    .group_by(
-        post_table.c.id
-    )  # and groups by post_table id => e.g. is a single row per post
+# The likes are counted in the posts table itself, so reading posts never
+# has to join or count the likes table.
+select_post_and_likes = sqlalchemy.select(post_table)
+
+# Caches pages of GET /posts and posts of GET /post/{post_id}. Writes drop
+# exactly the entries they change, found through the tags of the entries:
+#   post:{id}         everything showing the post, its image or its likes
+#   comments:{id}     the post with its embedded comments
+#   feed:new_post     the feed pages a newly created post shows up in
+#   feed:most_likes   every feed page sorted by likes
+post_cache = TTLCache(
+    max_size=config.POST_CACHE_MAX_SIZE,
+    ttl=config.POST_CACHE_TTL_SECONDS,
+    enabled=config.POST_CACHE_ENABLED,
 )
 
+# Versions of the feed and of every post, for the ETag and Last-Modified
+# headers. Clients revalidating with them get a 304 without any query.
+post_versions = VersionStamps(max_age=config.ETAG_MAX_AGE_SECONDS)
 
-async def find_post(post_id: int):
-    """This is the find_post_by_id function"""
-    logger.info(f"Finding post with id {post_id}")
-    # generates a query clause
-    # post_table.select() is equivalent to sqlalchemy.select([post_table]).select_from(post_table)
-    query = post_table.select().where(post_table.c.id == post_id)
-    logger.debug(query)
-    return await database.fetch_one(query)  # returns a SQLAlchemy Row object
+
+def post_created() -> None:
+    post_cache.invalidate_tag("feed:new_post")
+    post_versions.bump("feed")
+
+
+def post_changed(post_id: int) -> None:
+    post_cache.invalidate_tag(f"post:{post_id}")
+    post_versions.bump(f"post:{post_id}")
+    post_versions.bump("feed")
+
+
+def post_liked(post_id: int) -> None:
+    post_changed(post_id)
+    # the post may move up in the most_likes order
+    post_cache.invalidate_tag("feed:most_likes")
+
+
+def post_commented(post_id: int) -> None:
+    post_cache.invalidate_tag(f"comments:{post_id}")
+    post_versions.bump(f"post:{post_id}")
+
+
+def reader_for(key: str) -> Database:
+    """Picks the database to read a feed or post from.
+
+    Reads go to the replica, unless this process changed the resource so
+    recently that the replica may not have it yet.
+    """
+    lag = config.READ_REPLICA_MAX_LAG_SECONDS
+    if post_versions.modified_at(key) > time.time() - lag:
+        return database
+    return read_database
+
+
+@contextmanager
+def post_must_exist():
+    """Turns a violated foreign key on the post into a 404.
+
+    Writes rely on the foreign keys to posts instead of looking the post up
+    first, which saves a round trip to the database.
+    """
+    try:
+        yield
+    except Exception as e:
+        if is_foreign_key_violation(e):
+            raise HTTPException(status_code=404, detail="Post not found") from e
+        raise
 
 
 @router.post("/post", response_model=UserPost, status_code=201)
 async def create_post(
     post: UserPostIn,
-    current_user: Annotated[User, Depends(get_current_user)],
+    current_user: Annotated[User, Depends(get_token_user)],
     background_tasks: BackgroundTasks,
     request: Request,
     prompt: str = None,
@@ -70,105 +161,443 @@ async def create_post(
     query = post_table.insert().values(data)  # keys need to match columns in the table
     logger.debug(query)
     last_record_id = await database.execute(query)  # returns the id of the new record
+    post_created()
 
     if prompt:
         background_tasks.add_task(
-            generate_and_add_to_post,
+            add_image_to_post,
             current_user.email,
             last_record_id,
             request.url_for("get_post_with_comments", post_id=last_record_id),
-            database,
             prompt,
         )
 
     return {**data, "id": last_record_id}
 
 
+async def add_image_to_post(email: str, post_id: int, post_url: str, prompt: str):
+    """Generates the image of a post and drops the cached versions of the post."""
+    await generate_and_add_to_post(email, post_id, post_url, database, prompt)
+    post_changed(post_id)
+
+
 class PostSorting(str, Enum):
     new = "new"
     old = "old"
     most_likes = "most_likes"
 
 
-@router.get("/posts", response_model=list[UserPostWithLikes])
-# FastAPI, knows that the PostSorting parameter is a query parameter,
-# as it is of type Enum.
-# http://api.com/posts?sorting=most_likes
-async def get_all_posts(sorting: PostSorting = PostSorting.new):
-    """This is returns all posts of the API"""
-    logger.info("Getting all posts.")
+def paginate_posts(sorting: PostSorting, cursor: Optional[str]):
+    """Orders the posts and skips to the position after the cursor.
+
+    Every sorting ends on post_table.c.id, so rows with equal likes keep a
+    stable order and no page skips or repeats a post.
+    """
     if sorting == PostSorting.new:
         query = select_post_and_likes.order_by(post_table.c.id.desc())
+        if cursor:
+            position = decode_cursor(cursor, sorting.value, id=int)
+            query = query.where(post_table.c.id < position["id"])
     elif sorting == PostSorting.old:
         query = select_post_and_likes.order_by(post_table.c.id.asc())
+        if cursor:
+            position = decode_cursor(cursor, sorting.value, id=int)
+            query = query.where(post_table.c.id > position["id"])
     elif sorting == PostSorting.most_likes:
-        query = select_post_and_likes.order_by(sqlalchemy.desc("likes"))
+        query = select_post_and_likes.order_by(
+            post_table.c.likes.desc(), post_table.c.id.desc()
+        )
+        if cursor:
+            position = decode_cursor(cursor, sorting.value, likes=int, id=int)
+            query = query.where(
+                sqlalchemy.or_(
+                    post_table.c.likes < position["likes"],
+                    sqlalchemy.and_(
+                        post_table.c.likes == position["likes"],
+                        post_table.c.id < position["id"],
+                    ),
+                )
+            )
     else:
         logger.error("Unknown sorting option", extra={"sorting": sorting})
-    # Newer way in Python to do this:
-    # match sorting:
-    #     case PostSorting.new:
-    #         query = select_post_and_likes.order_by(sqlalchemy.desc(post_table.c.id))
-    logger.debug(query)
-    return await database.fetch_all(query)
+    return query
+
+
+def next_posts_cursor(sorting: PostSorting, last_post: dict) -> str:
+    """Returns the cursor pointing behind the last post of a page."""
+    if sorting == PostSorting.most_likes:
+        return encode_cursor(
+            sorting.value, likes=last_post["likes"], id=last_post["id"]
+        )
+    return encode_cursor(sorting.value, id=last_post["id"])
+
+
+def feed_page_tags(sorting: PostSorting, cursor: Optional[str], page: tuple) -> set:
+    """Tags a cached feed page with everything that changes it."""
+    posts, next_cursor = page
+    tags = {f"feed:{sorting.value}"} | {f"post:{post['id']}" for post in posts}
+    # A new post has the highest id and no likes yet, so it shows up on the
+    # first page of new, the last page of old and, sorted by likes, in front
+    # of the posts without likes.
+    if (
+        (sorting == PostSorting.new and cursor is None)
+        or (sorting == PostSorting.old and next_cursor is None)
+        or (
+            sorting == PostSorting.most_likes
+            and (next_cursor is None or posts[-1]["likes"] == 0)
+        )
+    ):
+        tags.add("feed:new_post")
+    return tags
+
+
+@router.get(
+    "/posts", response_model=list[UserPostWithLikes], responses=NDJSON_RESPONSES
+)
+# FastAPI, knows that the PostSorting parameter is a query parameter,
+# as it is of type Enum.
+# http://api.com/posts?sorting=most_likes
+async def get_all_posts(
+    request: Request,
+    sorting: PostSorting = PostSorting.new,
+    limit: Optional[int] = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+):
+    """This is returns a page of posts of the API
+
+    If there are more posts, the cursor for the next page is sent in the
+    X-Next-Cursor header. A streamed response (NDJSON) is not paged, it
+    runs from the cursor to the end unless a limit is given. Clients can
+    revalidate a page with If-None-Match or If-Modified-Since.
+    """
+    logger.info("Getting all posts.")
+    streaming = wants_ndjson(request, stream)
+    etag, last_modified = post_versions.stamp(
+        "feed", sorting.value, cursor, limit, streaming
+    )
+    headers = validator_headers(etag, last_modified)
+    if is_not_modified(request, etag, last_modified):
+        return not_modified_response(headers)
+
+    query = paginate_posts(sorting, cursor)
+    if streaming:
+        if limit:
+            query = query.limit(limit)
+        logger.debug(query)
+        return ndjson_response(
+            reader_for("feed").iterate(query), UserPostWithLikes, headers
+        )
+
+    limit = limit or DEFAULT_PAGE_SIZE
+    cache_key = ("posts", sorting.value, cursor, limit)
+    page = post_cache.get(cache_key)
+    if page is None:
+        # Fetching one row more than requested tells us if there is a next page.
+        query = query.limit(limit + 1)
+        # Newer way in Python to do this:
+        # match sorting:
+        #     case PostSorting.new:
+        #         query = select_post_and_likes.order_by(sqlalchemy.desc(post_table.c.id))
+        logger.debug(query)
+        rows = await reader_for("feed").fetch_all(query)
+        posts = [dict(post._mapping) for post in rows]
+        next_cursor = None
+        if len(posts) > limit:
+            posts = posts[:limit]
+            next_cursor = next_posts_cursor(sorting, posts[-1])
+        page = (posts, next_cursor)
+        post_cache.set(cache_key, page, tags=feed_page_tags(sorting, cursor, page))
+
+    posts, next_cursor = page
+    if next_cursor:
+        headers[NEXT_CURSOR_HEADER] = next_cursor
+    return rows_response(posts, UserPostWithLikes, headers)
 
 
 @router.post("/comment", response_model=Comment, status_code=201)
 async def create_comment(
-    comment: CommentIn, current_user: Annotated[User, Depends(get_current_user)]
+    comment: CommentIn, current_user: Annotated[User, Depends(get_token_user)]
 ):
     """This is the create_comment path of the API"""
     logger.info("Creating comment on post")
-    post = await find_post(comment.post_id)
-    if not post:
-        raise HTTPException(status_code=404, detail="Post not found")
-
     data = {**comment.model_dump(), "user_id": current_user.id}
     query = comment_table.insert().values(data)
     # logger.debug(query, extra={"post_id": post.id, "email": "bob@example.com"})
     logger.debug(query)
-    last_record_id = await database.execute(query)
+    with post_must_exist():
+        last_record_id = await database.execute(query)
+    post_commented(comment.post_id)
     return {**data, "id": last_record_id}
 
 
-@router.get("/post/{post_id}/comment", response_model=list[Comment])
-async def get_comments_on_post(post_id: int):
-    """This is the get_comments_on_post path of the API"""
+def paginate_comments(post_id: int, cursor: Optional[str]):
+    """Orders the comments of a post by id, starting behind the cursor."""
+    query = (
+        comment_table.select()
+        .where(comment_table.c.post_id == post_id)
+        .order_by(comment_table.c.id)
+    )
+    if cursor:
+        position = decode_cursor(cursor, "comments", id=int)
+        query = query.where(comment_table.c.id > position["id"])
+    return query
+
+
+def next_comments_cursor(last_comment) -> str:
+    """Returns the cursor pointing behind the last comment of a page."""
+    return encode_cursor("comments", id=last_comment["id"])
+
+
+@router.get(
+    "/post/{post_id}/comment",
+    response_model=list[Comment],
+    responses=NDJSON_RESPONSES,
+)
+async def get_comments_on_post(
+    post_id: int,
+    request: Request,
+    limit: Optional[int] = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+):
+    """This is the get_comments_on_post path of the API
+
+    Pages and streams like GET /posts.
+    """
     logger.info(f"Getting comments on post with id {post_id}")
-    query = comment_table.select().where(comment_table.c.post_id == post_id)
+    query = paginate_comments(post_id, cursor)
+    if wants_ndjson(request, stream):
+        if limit:
+            query = query.limit(limit)
+        logger.debug(query)
+        return ndjson_response(reader_for(f"post:{post_id}").iterate(query), Comment)
+
+    limit = limit or DEFAULT_PAGE_SIZE
+    query = query.limit(limit + 1)
     logger.debug(query)
-    return await database.fetch_all(query)
+    comments = await reader_for(f"post:{post_id}").fetch_all(query)
+    headers = {}
+    if len(comments) > limit:
+        comments = comments[:limit]
+        headers[NEXT_CURSOR_HEADER] = next_comments_cursor(comments[-1])
+    return rows_response(comments, Comment, headers)
+
+
+def select_post_with_comments(post_id: int, postgres: bool):
+    """Selects a post together with the first page of its comments.
+
+    The comments are aggregated into a JSON array inside the same statement,
+    so opening a post is a single round trip, no matter how many comments
+    it has. One comment more than a page is fetched to detect further pages.
+    """
+    page = (
+        comment_table.select()
+        .where(comment_table.c.post_id == post_table.c.id)
+        .order_by(comment_table.c.id)
+        .limit(DEFAULT_PAGE_SIZE + 1)
+        .correlate(post_table)
+        .subquery("comments_page")
+    )
+    # keys are rendered inline, PostgreSQL cannot infer the type of bound ones
+    fields = []
+    for column in page.c:
+        fields += [sqlalchemy.literal_column(f"'{column.name}'"), column]
+
+    if postgres:
+        comments = sqlalchemy.func.coalesce(
+            sqlalchemy.func.json_agg(
+                aggregate_order_by(
+                    sqlalchemy.func.json_build_object(*fields), page.c.id
+                )
+            ),
+            sqlalchemy.literal_column("'[]'::json"),
+        )
+    else:
+        # SQLite doesn't promise to aggregate in the order of the subquery,
+        # the comments are sorted after decoding
+        comments = sqlalchemy.func.json_group_array(
+            sqlalchemy.func.json_object(*fields)
+        )
+
+    return select_post_and_likes.add_columns(
+        sqlalchemy.select(comments)
+        .select_from(page)
+        .scalar_subquery()
+        .label("comments")
+    ).where(post_table.c.id == post_id)
 
 
 @router.get("/post/{post_id}", response_model=UserPostWithComments)
-async def get_post_with_comments(post_id: int):
-    """This is the get_post with comments path of the API"""
-    logger.info(f"Getting post with id {post_id} and all its comments")
-    # post = await find_post(post_id)
-    query = select_post_and_likes.where(post_table.c.id == post_id)
+async def get_post_with_comments(post_id: int, request: Request):
+    """This is the get_post with comments path of the API
+
+    Only the first page of comments is embedded, the comments_cursor
+    continues at GET /post/{post_id}/comment. Clients can revalidate the
+    post with If-None-Match or If-Modified-Since.
+    """
+    logger.info(f"Getting post with id {post_id} and its first comments")
+    etag, last_modified = post_versions.stamp(f"post:{post_id}")
+    headers = validator_headers(etag, last_modified)
+    if is_not_modified(request, etag, last_modified):
+        return not_modified_response(headers)
+
+    cache_key = ("post", post_id)
+    post_with_comments = post_cache.get(cache_key)
+    if post_with_comments is not None:
+        return ORJSONResponse(post_with_comments, headers=headers)
+
+    reader = reader_for(f"post:{post_id}")
+    query = select_post_with_comments(post_id, is_postgres(reader))
     logger.debug(query)
-    post = await database.fetch_one(query)
-    if not post:
+    row = await reader.fetch_one(query)
+    if not row:
         raise HTTPException(status_code=404, detail="Post not found")
 
-    return {
-        "post": post,
-        "comments": await get_comments_on_post(post_id),
+    comments = sorted(orjson.loads(row.comments), key=itemgetter("id"))
+    comments_cursor = None
+    if len(comments) > DEFAULT_PAGE_SIZE:
+        comments = comments[:DEFAULT_PAGE_SIZE]
+        comments_cursor = next_comments_cursor(comments[-1])
+    post_with_comments = {
+        "post": project(row, UserPostWithLikes),
+        "comments": [project(comment, Comment) for comment in comments],
+        "comments_cursor": comments_cursor,
     }
+    post_cache.set(
+        cache_key, post_with_comments, tags={f"post:{post_id}", f"comments:{post_id}"}
+    )
+    return ORJSONResponse(post_with_comments, headers=headers)
 
 
 @router.post("/post/{post_id}/like", response_model=PostLike, status_code=201)
 async def like_post(
-    like: PostLikeIn, current_user: Annotated[User, Depends(get_current_user)]
+    like: PostLikeIn,
+    current_user: Annotated[User, Depends(get_token_user)],
+    response: Response,
 ):
-    """This is the like_post path of the API"""
-    logger.info("Liking post")
-    post = await find_post(like.post_id)
-    if not post:
-        raise HTTPException(status_code=404, detail="Post not found")
+    """This is the like_post path of the API
 
+    Liking a post again changes nothing and answers 200 without a like id,
+    so clients can safely retry.
+    """
+    logger.info("Liking post")
     data = {**like.model_dump(), "user_id": current_user.id}
-    query = like_table.insert().values(data)
+    # a single statement, the like counter of the post is kept by a trigger
+    query = insert_likes_query([data], is_postgres(database))
     logger.debug(query)
-    last_record_id = await database.execute(query)
-    return {**data, "id": last_record_id}
+    with post_must_exist():
+        inserted = await database.fetch_one(query)
+    if inserted is None:
+        response.status_code = 200
+        return data
+    post_liked(like.post_id)
+    return {**data, "id": inserted.id}
+
+
+@router.delete("/post/{post_id}/like", status_code=204)
+async def unlike_post(
+    post_id: int, current_user: Annotated[User, Depends(get_token_user)]
+):
+    """Removes the like of the current user from a post, if there is one"""
+    logger.info("Unliking post")
+    query = like_table.delete().where(
+        (like_table.c.post_id == post_id) & (like_table.c.user_id == current_user.id)
+    )
+    logger.debug(query)
+    await database.execute(query)
+    post_liked(post_id)
+
+
+# The bulk endpoints take arrays, so that importers and offline clients can
+# send hundreds of items in one request. Every item gets its own result.
+BulkItems = Body(min_length=1, max_length=config.BULK_MAX_ITEMS)
+
+
+async def find_existing_post_ids(post_ids: set[int]) -> set[int]:
+    """Returns which of the post ids exist, with a single query."""
+    query = sqlalchemy.select(post_table.c.id).where(post_table.c.id.in_(post_ids))
+    logger.debug(query)
+    return {row.id for row in await database.fetch_all(query)}
+
+
+def post_not_found_result(index: int) -> dict:
+    return {"index": index, "status_code": 404, "detail": "Post not found"}
+
+
+@router.post("/posts/bulk", response_model=list[BulkItemResult])
+async def create_posts_bulk(
+    posts: Annotated[list[UserPostIn], BulkItems],
+    current_user: Annotated[User, Depends(get_token_user)],
+):
+    """Creates many posts with one statement"""
+    logger.info(f"Creating {len(posts)} posts")
+    rows = [{**post.model_dump(), "user_id": current_user.id} for post in posts]
+    async with database.transaction():
+        ids = await insert_returning_ids(database, post_table, rows)
+    post_created()
+    return [
+        {"index": index, "status_code": 201, "id": post_id}
+        for index, post_id in enumerate(ids)
+    ]
+
+
+@router.post("/comments/bulk", response_model=list[BulkItemResult])
+async def create_comments_bulk(
+    comments: Annotated[list[CommentIn], BulkItems],
+    current_user: Annotated[User, Depends(get_token_user)],
+):
+    """Creates many comments, skipping those on posts that do not exist"""
+    logger.info(f"Creating {len(comments)} comments")
+    async with database.transaction():
+        existing = await find_existing_post_ids({c.post_id for c in comments})
+        accepted = [i for i, c in enumerate(comments) if c.post_id in existing]
+        rows = [
+            {**comments[i].model_dump(), "user_id": current_user.id} for i in accepted
+        ]
+        ids = await insert_returning_ids(database, comment_table, rows) if rows else []
+
+    for post_id in {row["post_id"] for row in rows}:
+        post_commented(post_id)
+    created = dict(zip(accepted, ids))
+    return [
+        {"index": index, "status_code": 201, "id": created[index]}
+        if index in created
+        else post_not_found_result(index)
+        for index in range(len(comments))
+    ]
+
+
+@router.post("/likes/bulk", response_model=list[BulkItemResult])
+async def like_posts_bulk(
+    likes: Annotated[list[PostLikeIn], BulkItems],
+    current_user: Annotated[User, Depends(get_token_user)],
+):
+    """Likes many posts, skipping those that do not exist"""
+    logger.info(f"Liking {len(likes)} posts")
+    async with database.transaction():
+        existing = await find_existing_post_ids({like.post_id for like in likes})
+        accepted = [i for i, like in enumerate(likes) if like.post_id in existing]
+        rows = [{**likes[i].model_dump(), "user_id": current_user.id} for i in accepted]
+        inserted = []
+        if rows:
+            query = insert_likes_query(rows, is_postgres(database))
+            logger.debug(query)
+            inserted = await database.fetch_all(query)
+
+    # a user likes a post once, so the post identifies the new like
+    new_likes = {like.post_id: like.id for like in inserted}
+    for post_id in new_likes:
+        post_liked(post_id)
+    results = []
+    for index, like in enumerate(likes):
+        if like.post_id not in existing:
+            results.append(post_not_found_result(index))
+        elif like.post_id in new_likes:
+            like_id = new_likes.pop(like.post_id)
+            results.append({"index": index, "status_code": 201, "id": like_id})
+        else:
+            results.append(
+                {"index": index, "status_code": 200, "detail": "Already liked"}
+            )
+    return results
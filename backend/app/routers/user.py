@@ -1,16 +1,24 @@
 import logging
-from typing import Annotated
+from typing import Annotated, Optional
 
 from app import tasks
 from app.database import database, user_table
-from app.models.user import UserIn
+from app.models.user import RefreshTokenIn, UserIn
+from app.ratelimit import auth_limiter
 from app.security import (
     authenticate_user,
     create_access_token,
     create_confirmation_token,
+    create_credentials_exception,
+    create_refresh_token,
+    get_claims_for_token_type,
     get_password_hash,
     get_subject_for_token_type,
     get_user,
+    oauth2_scheme,
+    revoke_token,
+    run_password_task,
+    user_changed,
 )
 from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordRequestForm
@@ -22,12 +30,15 @@ router = APIRouter()
 @router.post("/register", status_code=201)
 async def register(user: UserIn, background_tasks: BackgroundTasks, request: Request):
     """This is the register path of the API"""
-    if await get_user(user.email):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="A user with that email already exists",
-        )
-    hashed_password = get_password_hash(user.password)
+    with auth_limiter.admit(
+        request.client.host if request.client else None, user.email
+    ):
+        if await get_user(user.email):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="A user with that email already exists",
+            )
+        hashed_password = await run_password_task(get_password_hash, user.password)
     query = user_table.insert().values(email=user.email, password=hashed_password)
     logger.debug(query)
     await database.execute(query)
@@ -45,12 +56,59 @@ async def register(user: UserIn, background_tasks: BackgroundTasks, request: Req
     }
 
 
+def create_tokens(user) -> dict:
+    return {
+        "access_token": create_access_token(user.email, user.id, user.confirmed),
+        "refresh_token": create_refresh_token(user.email),
+        "token_type": "bearer",
+    }
+
+
 @router.post("/token")
-async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
+async def login(
+    form_data: Annotated[OAuth2PasswordRequestForm, Depends()], request: Request
+):
     """This is the login path of the API"""
-    await authenticate_user(form_data.username, form_data.password)
-    access_token = create_access_token(form_data.username)
-    return {"access_token": access_token, "token_type": "bearer"}
+    with auth_limiter.admit(
+        request.client.host if request.client else None, form_data.username
+    ):
+        user = await authenticate_user(form_data.username, form_data.password)
+    return create_tokens(user)
+
+
+@router.post("/token/refresh")
+async def refresh_tokens(body: RefreshTokenIn):
+    """This is the refresh path of the API
+
+    Exchanges a refresh token for new tokens without hashing the password.
+    Every refresh token works only once, it is revoked on the way.
+    """
+    claims = get_claims_for_token_type(body.refresh_token, "refresh")
+    if not await revoke_token(claims):
+        raise create_credentials_exception("Token has been revoked")
+    user = await get_user(claims["sub"])
+    if user is None:
+        raise create_credentials_exception("User not found")
+    if not user.confirmed:
+        raise create_credentials_exception("Email not confirmed.")
+    return create_tokens(user)
+
+
+@router.post("/logout")
+async def logout(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    body: Optional[RefreshTokenIn] = None,
+):
+    """This is the logout path of the API
+
+    Revokes the access token and, if given, the refresh token.
+    """
+    claims = get_claims_for_token_type(token, "access")
+    if "jti" in claims:
+        await revoke_token(claims)
+    if body is not None:
+        await revoke_token(get_claims_for_token_type(body.refresh_token, "refresh"))
+    return {"detail": "Logged out"}
 
 
 @router.get("/confirm/{token}")
@@ -62,5 +120,6 @@ async def confirm_email(token: str):
     )
     logger.debug(query)
     await database.execute(query)
+    user_changed(email)
 
     return {"detail": "User confirmed"}
@@ -1,9 +1,20 @@
+import argparse
+import asyncio
 import datetime
+import hashlib
 import logging
-from typing import Annotated, Literal
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Annotated, Any, Callable, Literal, Optional
 
+from app.cache import TTLCache
 from app.config import config
 from app.database import database, user_table
+from app.logging_config import configure_logging
+from app.metrics import Counter, Histogram
+from app.models.user import User
+from app.revocation import revocation_list
 from fastapi import Depends, HTTPException, status
 
 # from fastapi.openapi.utils import get_openapi
@@ -34,7 +45,29 @@ logger = logging.getLogger(__name__)
 # 2. when calling oauth2_scheme, it will automatically return the token
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 # oauth2_scheme = OAuth2AuthorizationCodeBearer(tokenUrl="token")
-pwd_context = CryptContext(schemes=["bcrypt"])
+pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=config.BCRYPT_ROUNDS)
+
+# bcrypt takes a few hundred milliseconds on purpose, so it runs on these
+# threads instead of blocking the event loop (bcrypt releases the GIL)
+password_executor = ThreadPoolExecutor(
+    max_workers=config.PASSWORD_HASH_WORKERS, thread_name_prefix="password"
+)
+pending_password_tasks = 0
+password_queue_wait = Histogram(
+    "password_queue_wait_seconds",
+    "Time password hashing and verification waited for a free thread",
+)
+# Users behind access tokens, by email. Writes to a user drop its entry
+# through user_changed().
+user_cache = TTLCache(
+    max_size=config.USER_CACHE_MAX_SIZE,
+    ttl=config.USER_CACHE_TTL_SECONDS,
+    enabled=config.USER_CACHE_ENABLED,
+)
+password_tasks_rejected = Counter(
+    "password_tasks_rejected_total",
+    "Password hashing and verification rejected as too many were pending",
+)
 
 
 # def get_openapi_schema():
@@ -60,7 +93,7 @@ def create_credentials_exception(detail: str):
 
 def access_token_expire_minutes() -> str:
     """Returns the access token expire time in minutes."""
-    return 30
+    return config.ACCESS_TOKEN_EXPIRE_MINUTES
 
 
 def confirm_token_expire_minutes() -> str:
@@ -68,8 +101,19 @@ def confirm_token_expire_minutes() -> str:
     return 60 * 24
 
 
-def create_access_token(email: dict):
-    """Creates an access token."""
+def refresh_token_expire_minutes() -> int:
+    """Returns the refresh token expire time in minutes."""
+    return config.REFRESH_TOKEN_EXPIRE_DAYS * 60 * 24
+
+
+def create_access_token(
+    email: dict, user_id: Optional[int] = None, confirmed: Optional[bool] = None
+):
+    """Creates an access token.
+
+    With STATELESS_AUTH, the token also carries the id and confirmed flag
+    of the user, as the uid and confirmed claims.
+    """
     logger.debug("Creating access token", extra={"email": email})
     expire = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
         minutes=access_token_expire_minutes()
@@ -78,7 +122,11 @@ def create_access_token(email: dict):
         "sub": email,
         "exp": expire,
         "type": "access",  # to distinguish between access and confirm tokens
+        "jti": uuid.uuid4().hex,  # identifies the token, if it gets revoked
     }
+    if config.STATELESS_AUTH and user_id is not None:
+        jwt_payload["uid"] = user_id
+        jwt_payload["confirmed"] = bool(confirmed)
     encoded_jwt = jwt.encode(
         jwt_payload, key=config.SECRET_KEY, algorithm=config.ALGORITHM
     )
@@ -102,11 +150,43 @@ def create_confirmation_token(email: dict):
     return encoded_jwt
 
 
-def get_subject_for_token_type(
-    token: str, type: Literal["access", "confirmation"]
-) -> str:
+# Verified claims by token type and token hash. Every entry expires with its
+# token, so an expired token is never taken from the cache.
+claims_cache = TTLCache(
+    max_size=config.CLAIMS_CACHE_MAX_SIZE,
+    ttl=0,
+    enabled=config.CLAIMS_CACHE_ENABLED,
+)
+
+
+def create_refresh_token(email: dict):
+    """Creates a refresh token, which is exchanged for new tokens only once."""
+    logger.debug("Creating refresh token", extra={"email": email})
+    expire = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+        minutes=refresh_token_expire_minutes()
+    )
+    jwt_payload = {
+        "sub": email,
+        "exp": expire,
+        "type": "refresh",
+        "jti": uuid.uuid4().hex,
+    }
+    encoded_jwt = jwt.encode(
+        jwt_payload, key=config.SECRET_KEY, algorithm=config.ALGORITHM
+    )
+    return encoded_jwt
+
+
+def get_claims_for_token_type(
+    token: str, type: Literal["access", "confirmation", "refresh"]
+) -> dict:
+    """Verifies a token and returns its claims, checked for a cached result first."""
     if not token:
         raise create_credentials_exception("Token not present.")
+    cache_key = (type, hashlib.sha256(token.encode()).digest())
+    payload = claims_cache.get(cache_key)
+    if payload is not None:
+        return payload
     try:
         payload = jwt.decode(
             token, key=config.SECRET_KEY, algorithms=[config.ALGORITHM]
@@ -123,7 +203,15 @@ def get_subject_for_token_type(
         raise create_credentials_exception(
             f"Token is of incorrect type, expected '{type}'"
         )
-    return email
+    if "exp" in payload:
+        claims_cache.set(cache_key, payload, ttl=payload["exp"] - time.time())
+    return payload
+
+
+def get_subject_for_token_type(
+    token: str, type: Literal["access", "confirmation", "refresh"]
+) -> str:
+    return get_claims_for_token_type(token, type)["sub"]
 
 
 def get_password_hash(password: str) -> str:
@@ -134,6 +222,61 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
+def verify_and_update_password(
+    plain_password: str, hashed_password: str
+) -> tuple[bool, Optional[str]]:
+    """Verifies a password and rehashes it if its hash has outdated parameters."""
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+
+def calibrate_bcrypt_rounds(target_seconds: float) -> int:
+    """Returns the highest bcrypt cost whose verification meets the target time."""
+    best = 4
+    for rounds in range(4, 20):
+        context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=rounds)
+        hashed_password = context.hash("calibration")
+        start = time.perf_counter()
+        context.verify("calibration", hashed_password)
+        elapsed = time.perf_counter() - start
+        logger.info(f"bcrypt with {rounds} rounds verifies in {elapsed * 1000:.0f} ms")
+        if elapsed > target_seconds:
+            break
+        best = rounds
+    return best
+
+
+async def run_password_task(func: Callable[..., Any], *args: Any) -> Any:
+    """Runs a password hashing function on the password threads.
+
+    Answers 503 once PASSWORD_HASH_MAX_PENDING calls are pending, so that a
+    burst of logins can not queue up without bounds.
+    """
+    global pending_password_tasks
+    if pending_password_tasks >= config.PASSWORD_HASH_MAX_PENDING:
+        password_tasks_rejected.inc()
+        logger.warning("Too many pending password tasks")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many logins at once, please try again shortly.",
+            headers={"Retry-After": "1"},
+        )
+
+    queued_at = time.perf_counter()
+
+    def timed():
+        waited = time.perf_counter() - queued_at
+        return waited, func(*args)
+
+    pending_password_tasks += 1
+    try:
+        loop = asyncio.get_running_loop()
+        waited, result = await loop.run_in_executor(password_executor, timed)
+    finally:
+        pending_password_tasks -= 1
+    password_queue_wait.observe(waited)
+    return result
+
+
 async def get_user(email: str):
     """Gets a user from the database by email."""
 
@@ -144,6 +287,22 @@ async def get_user(email: str):
         return result
 
 
+async def ensure_not_revoked(claims: dict) -> None:
+    """Rejects revoked tokens; tokens issued without a jti can not be revoked."""
+    jti = claims.get("jti")
+    if jti is not None and await revocation_list.is_revoked(database, jti):
+        raise create_credentials_exception("Token has been revoked")
+
+
+async def revoke_token(claims: dict) -> bool:
+    """Revokes a token, returns False if it was revoked already."""
+    return await revocation_list.revoke(database, claims["jti"], claims["exp"])
+
+
+def user_changed(email: str) -> None:
+    user_cache.invalidate(email)
+
+
 async def authenticate_user(email: str, password: str):
     """Authenticates a user."""
     logger.debug("Authenticating user with email", extra={"email": email})
@@ -151,8 +310,21 @@ async def authenticate_user(email: str, password: str):
     if not user:
         raise create_credentials_exception("Invalid email or password.")
     # note, user.password is the hashed password!
-    if not verify_password(password, user.password):
+    verified, new_hash = await run_password_task(
+        verify_and_update_password, password, user.password
+    )
+    if not verified:
         raise create_credentials_exception("Invalid email or password.")
+    if new_hash:
+        # the hash was made with other parameters than configured now
+        logger.info("Upgrading password hash", extra={"email": email})
+        query = (
+            user_table.update()
+            .where(user_table.c.id == user.id)
+            .values(password=new_hash)
+        )
+        await database.execute(query)
+        user_changed(email)
     if not user.confirmed:
         raise create_credentials_exception("Email not confirmed.")
     return user
@@ -161,9 +333,41 @@ async def authenticate_user(email: str, password: str):
 # The way arguments are past here is a dependency injection.
 # That means token now depends on oauth2_scheme.
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
-    """Gets the current user from the database."""
-    email = get_subject_for_token_type(token, "access")
-    user = await get_user(email)
+    """Gets the current user from the cache or the database."""
+    claims = get_claims_for_token_type(token, "access")
+    await ensure_not_revoked(claims)
+    email = claims["sub"]
+    user = user_cache.get(email)
     if user is None:
-        raise create_credentials_exception("User not found")
+        user = await get_user(email)
+        if user is None:
+            raise create_credentials_exception("User not found")
+        user_cache.set(email, user)
     return user
+
+
+async def get_token_user(token: Annotated[str, Depends(oauth2_scheme)]) -> User:
+    """Gets the current user from the claims of the access token.
+
+    Only needs the database for tokens without a uid claim, i.e. when
+    STATELESS_AUTH is off or the token was issued before it was turned on.
+    """
+    claims = get_claims_for_token_type(token, "access")
+    if not config.STATELESS_AUTH or "uid" not in claims:
+        return await get_current_user(token)
+    await ensure_not_revoked(claims)
+    if not claims.get("confirmed"):
+        raise create_credentials_exception("Email not confirmed.")
+    return User(id=claims["uid"], email=claims["sub"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Finds the bcrypt cost for a target verify time on this machine"
+    )
+    parser.add_argument("command", choices=["calibrate"])
+    parser.add_argument("--target-ms", type=float, default=250.0)
+    args = parser.parse_args()
+    configure_logging()
+    rounds = calibrate_bcrypt_rounds(args.target_ms / 1000)
+    print(f"BCRYPT_ROUNDS={rounds}")
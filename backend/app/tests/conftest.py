@@ -9,6 +9,11 @@ from httpx import AsyncClient, Request, Response
 os.environ["ENV_STATE"] = "test"  # noqa: E402
 from app.database import database, user_table  # noqa: E402
 from app.main import app  # noqa: E402
+from app.migrate import upgrade  # noqa: E402
+from app.ratelimit import auth_limiter  # noqa: E402
+from app.revocation import revocation_list  # noqa: E402
+from app.routers.post import post_cache, post_versions  # noqa: E402
+from app.security import claims_cache, user_cache  # noqa: E402
 from app.tests.helpers import create_post  # noqa: E402
 
 
@@ -30,10 +35,23 @@ def client() -> Generator:
 async def db() -> Generator:
     """Clears the database before each test."""
     await database.connect()
+    await upgrade(database)
     yield database
     await database.disconnect()
 
 
+@pytest.fixture(autouse=True)
+def clear_caches() -> Generator:
+    """Clears the in-process caches, as every test starts with an empty database."""
+    yield
+    post_cache.clear()
+    post_versions.clear()
+    user_cache.clear()
+    claims_cache.clear()
+    revocation_list.clear()
+    auth_limiter.clear()
+
+
 @pytest.fixture()
 # As the argument is another fixture, pytest will run the client fixture first and then pass the result to async_client.
 async def async_client(client) -> AsyncGenerator:
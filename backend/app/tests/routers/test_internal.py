@@ -0,0 +1,42 @@
+import pytest
+from app.config import config
+from httpx import AsyncClient
+
+
+@pytest.fixture(autouse=True)
+def metrics_token(mocker):
+    mocker.patch.object(config, "INTERNAL_METRICS_TOKEN", "secret")
+
+
+@pytest.mark.anyio
+async def test_get_metrics(async_client: AsyncClient):
+    """Test that the pool metrics and cache stats are reported."""
+    await async_client.get("/posts")
+    response = await async_client.get(
+        "/internal/metrics", headers={"Authorization": "Bearer secret"}
+    )
+    assert response.status_code == 200
+    metrics = response.json()["metrics"]
+    assert metrics["db_pool_in_use"]["type"] == "gauge"
+    assert metrics["db_pool_waiting"]["value"] == 0
+    assert metrics["db_pool_acquire_wait_seconds"]["count"] >= 1
+    assert {"posts", "users", "claims"} == response.json()["caches"].keys()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("authorization", [None, "Bearer wrong"])
+async def test_get_metrics_unauthorized(async_client: AsyncClient, authorization):
+    """Test that the metrics need the internal token."""
+    headers = {"Authorization": authorization} if authorization else {}
+    response = await async_client.get("/internal/metrics", headers=headers)
+    assert response.status_code == 403
+
+
+@pytest.mark.anyio
+async def test_get_metrics_turned_off(async_client: AsyncClient, mocker):
+    """Test that the metrics are not served without a configured token."""
+    mocker.patch.object(config, "INTERNAL_METRICS_TOKEN", None)
+    response = await async_client.get(
+        "/internal/metrics", headers={"Authorization": "Bearer None"}
+    )
+    assert response.status_code == 404
@@ -1,5 +1,12 @@
+import json
+import time
+
 import pytest
 from app import security
+from app.config import config
+from app.database import Database, post_table, user_table
+from app.migrate import upgrade
+from app.routers.post import post_cache
 from app.tests.helpers import create_comment, create_post, like_post
 from httpx import AsyncClient
 
@@ -46,6 +53,30 @@ async def test_create_post(
     }.items() <= response.json().items()
 
 
+@pytest.mark.anyio
+async def test_create_post_stateless_auth(
+    async_client: AsyncClient, confirmed_user: dict, mocker
+):
+    """Test that a stateless token creates a post without looking up the user."""
+    mocker.patch.object(config, "STATELESS_AUTH", True)
+    response = await async_client.post(
+        "/token",
+        data={"username": confirmed_user["email"], "password": "1234"},
+    )
+    token = response.json()["access_token"]
+    get_user = mocker.spy(security, "get_user")
+
+    response = await async_client.post(
+        "/post",
+        json={"body": "Test Post"},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    assert response.status_code == 201
+    assert confirmed_user["id"] == response.json()["user_id"]
+    assert get_user.call_count == 0
+
+
 @pytest.mark.anyio
 async def test_create_post_with_prompt(
     async_client: AsyncClient, logged_in_token: str, mock_generate_cute_creature_api
@@ -122,6 +153,54 @@ async def test_like_post(
     }.items() <= response.json().items()
 
 
+@pytest.mark.anyio
+async def test_like_missing_post(async_client: AsyncClient, logged_in_token: str):
+    """Test that liking a missing post is a 404."""
+    response = await async_client.post(
+        "/post/2/like",
+        json={"post_id": 2},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Post not found"
+
+
+@pytest.mark.anyio
+async def test_like_post_twice(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    """Test that liking a post again is accepted but counted once."""
+    await like_post(created_post["id"], async_client, logged_in_token)
+    response = await async_client.post(
+        f"/post/{created_post['id']}/like",
+        json={"post_id": created_post["id"]},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 200
+    assert response.json()["id"] is None
+    response = await async_client.get(f"/post/{created_post['id']}")
+    assert response.json()["post"]["likes"] == 1
+
+
+@pytest.mark.anyio
+async def test_unlike_post(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    """Test that a like can be taken back, also more than once."""
+    await like_post(created_post["id"], async_client, logged_in_token)
+    for _ in range(2):
+        response = await async_client.delete(
+            f"/post/{created_post['id']}/like",
+            headers={"Authorization": f"Bearer {logged_in_token}"},
+        )
+        assert response.status_code == 204
+
+    response = await async_client.get(f"/post/{created_post['id']}")
+    assert response.json()["post"]["likes"] == 0
+
+
 @pytest.mark.anyio
 async def test_get_all_posts(async_client: AsyncClient, created_post: dict):
     """Test that we can get all posts."""
@@ -176,6 +255,108 @@ async def test_all_posts_sort_likes(
     assert expected_order == post_ids
 
 
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "sorting, expected_order",
+    [
+        ("new", [3, 2, 1]),
+        ("old", [1, 2, 3]),
+        ("most_likes", [2, 3, 1]),
+    ],
+)
+async def test_all_posts_pagination(
+    async_client: AsyncClient,
+    logged_in_token: str,
+    sorting: str,
+    expected_order: list[int],
+):
+    """Test that paging through the posts returns every post exactly once."""
+    for i in range(3):
+        await create_post(f"Test Post {i}", async_client, logged_in_token)
+    await like_post(2, async_client, logged_in_token)
+
+    post_ids = []
+    params = {"sorting": sorting, "limit": 2}
+    while True:
+        response = await async_client.get("/posts", params=params)
+        assert response.status_code == 200
+        post_ids += [post["id"] for post in response.json()]
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["X-Next-Cursor"]
+
+    assert expected_order == post_ids
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_invalid_cursor(async_client: AsyncClient):
+    """Test that a malformed cursor returns an error."""
+    response = await async_client.get("/posts", params={"cursor": "not a cursor"})
+    assert response.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_cursor_of_other_sorting(
+    async_client: AsyncClient, logged_in_token: str
+):
+    """Test that a cursor can only be used with the sorting it was issued for."""
+    await create_post("Test Post 1", async_client, logged_in_token)
+    await create_post("Test Post 2", async_client, logged_in_token)
+    response = await async_client.get("/posts", params={"limit": 1})
+    cursor = response.headers["X-Next-Cursor"]
+
+    response = await async_client.get(
+        "/posts", params={"sorting": "most_likes", "cursor": cursor}
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "params, headers",
+    [
+        ({"stream": "true"}, {}),
+        ({}, {"Accept": "application/x-ndjson"}),
+    ],
+)
+async def test_get_all_posts_stream(
+    async_client: AsyncClient,
+    logged_in_token: str,
+    params: dict,
+    headers: dict,
+):
+    """Test that posts can be streamed as newline delimited JSON."""
+    await create_post("Test Post 1", async_client, logged_in_token)
+    await create_post("Test Post 2", async_client, logged_in_token)
+    response = await async_client.get("/posts", params=params, headers=headers)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    posts = [json.loads(line) for line in response.text.splitlines()]
+    assert [2, 1] == [post["id"] for post in posts]
+    assert {"body", "id", "user_id", "image_url", "likes"} == posts[0].keys()
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_cached(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    """Test that feed pages are cached and refreshed by likes and new posts."""
+    await async_client.get("/posts")
+    hits = post_cache.hits
+    response = await async_client.get("/posts")
+    assert post_cache.hits == hits + 1
+    assert [{**created_post, "likes": 0}] == response.json()
+
+    await like_post(created_post["id"], async_client, logged_in_token)
+    response = await async_client.get("/posts")
+    assert 1 == response.json()[0]["likes"]
+
+    await create_post("Test Post 2", async_client, logged_in_token)
+    response = await async_client.get("/posts")
+    assert [2, 1] == [post["id"] for post in response.json()]
+
+
 @pytest.mark.anyio
 async def test_get_all_posts_wrong_sorting(async_client: AsyncClient):
     """Test that a wrong sorting parameter returns an error."""
@@ -210,6 +391,21 @@ async def test_create_comment(
     }.items() <= response.json().items()
 
 
+@pytest.mark.anyio
+async def test_create_comment_missing_post(
+    async_client: AsyncClient, logged_in_token: str
+):
+    """Test that commenting on a missing post is a 404."""
+    response = await async_client.post(
+        "/comment",
+        json={"body": "Test Comment", "post_id": 2},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Post not found"
+
+
 @pytest.mark.anyio
 async def test_get_comments_on_post(
     async_client: AsyncClient, created_post: dict, created_comment: dict
@@ -220,6 +416,20 @@ async def test_get_comments_on_post(
     assert response.json() == [created_comment]
 
 
+@pytest.mark.anyio
+async def test_get_comments_on_post_stream(
+    async_client: AsyncClient, created_post: dict, created_comment: dict
+):
+    response = await async_client.get(
+        f"/post/{created_post['id']}/comment", params={"stream": "true"}
+    )
+
+    assert response.status_code == 200
+    assert [json.loads(line) for line in response.text.splitlines()] == [
+        created_comment
+    ]
+
+
 @pytest.mark.anyio
 async def test_get_comments_on_post_empty(
     async_client: AsyncClient, created_post: dict
@@ -240,9 +450,49 @@ async def test_get_post_with_comments(
     assert response.json() == {
         "post": {**created_post, "likes": 0},
         "comments": [created_comment],
+        "comments_cursor": None,
     }
 
 
+@pytest.mark.anyio
+async def test_get_post_with_comments_cached(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    """Test that a cached post is refreshed by a new comment."""
+    await async_client.get(f"/post/{created_post['id']}")
+    comment = await create_comment(
+        "Test Comment", created_post["id"], async_client, logged_in_token
+    )
+    response = await async_client.get(f"/post/{created_post['id']}")
+
+    assert [comment] == response.json()["comments"]
+
+
+@pytest.mark.anyio
+async def test_get_post_with_comments_paginated(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    """Test that only the first page of comments is embedded in the post."""
+    for i in range(25):
+        await create_comment(
+            f"Test Comment {i}", created_post["id"], async_client, logged_in_token
+        )
+    response = await async_client.get(f"/post/{created_post['id']}")
+
+    assert response.status_code == 200
+    data = response.json()
+    assert list(range(1, 21)) == [comment["id"] for comment in data["comments"]]
+    assert data["comments_cursor"]
+
+    response = await async_client.get(
+        f"/post/{created_post['id']}/comment",
+        params={"cursor": data["comments_cursor"]},
+    )
+    assert response.status_code == 200
+    assert list(range(21, 26)) == [comment["id"] for comment in response.json()]
+    assert "X-Next-Cursor" not in response.headers
+
+
 @pytest.mark.anyio
 async def test_get_missing_post_with_comments(
     async_client: AsyncClient, created_post: dict, created_comment: dict
@@ -250,3 +500,171 @@ async def test_get_missing_post_with_comments(
     response = await async_client.get("/post/2")
 
     assert response.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_create_posts_bulk(
+    async_client: AsyncClient, confirmed_user: dict, logged_in_token: str
+):
+    """Test that many posts are created with one request."""
+    response = await async_client.post(
+        "/posts/bulk",
+        json=[{"body": "Test Post 1"}, {"body": "Test Post 2"}],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 200
+    assert [201, 201] == [item["status_code"] for item in response.json()]
+    response = await async_client.get("/posts", params={"sorting": "old"})
+    assert ["Test Post 1", "Test Post 2"] == [post["body"] for post in response.json()]
+
+
+@pytest.mark.anyio
+async def test_create_comments_bulk_missing_post(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    """Test that comments on missing posts are reported per item."""
+    response = await async_client.post(
+        "/comments/bulk",
+        json=[
+            {"body": "Test Comment 1", "post_id": created_post["id"]},
+            {"body": "Test Comment 2", "post_id": 99},
+            {"body": "Test Comment 3", "post_id": created_post["id"]},
+        ],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 200
+    assert [
+        {"index": 0, "status_code": 201, "id": 1, "detail": None},
+        {"index": 1, "status_code": 404, "id": None, "detail": "Post not found"},
+        {"index": 2, "status_code": 201, "id": 2, "detail": None},
+    ] == response.json()
+
+
+@pytest.mark.anyio
+async def test_like_posts_bulk(
+    async_client: AsyncClient, logged_in_token: str, confirmed_user: dict
+):
+    """Test that bulk likes are added to the like counters."""
+    await create_post("Test Post 1", async_client, logged_in_token)
+    await create_post("Test Post 2", async_client, logged_in_token)
+    response = await async_client.post(
+        "/likes/bulk",
+        json=[{"post_id": 2}, {"post_id": 1}, {"post_id": 2}, {"post_id": 3}],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 200
+    assert [201, 201, 200, 404] == [item["status_code"] for item in response.json()]
+    response = await async_client.get("/posts", params={"sorting": "most_likes"})
+    assert [(2, 1), (1, 1)] == [(post["id"], post["likes"]) for post in response.json()]
+
+
+@pytest.mark.anyio
+async def test_bulk_empty(async_client: AsyncClient, logged_in_token: str):
+    """Test that an empty bulk request is rejected."""
+    response = await async_client.post(
+        "/posts/bulk",
+        json=[],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert response.status_code == 422
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_not_modified(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    """Test that an unchanged feed page is revalidated with a 304."""
+    response = await async_client.get("/posts")
+    etag = response.headers["etag"]
+    assert "last-modified" in response.headers
+
+    response = await async_client.get("/posts", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+
+    response = await async_client.get(
+        "/posts", params={"sorting": "old"}, headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 200
+
+    await like_post(created_post["id"], async_client, logged_in_token)
+    response = await async_client.get("/posts", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert 1 == response.json()[0]["likes"]
+
+
+@pytest.mark.anyio
+async def test_get_post_with_comments_not_modified(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    """Test that a post is revalidated with ETag and Last-Modified."""
+    response = await async_client.get(f"/post/{created_post['id']}")
+    etag = response.headers["etag"]
+    last_modified = response.headers["last-modified"]
+
+    response = await async_client.get(
+        f"/post/{created_post['id']}", headers={"If-Modified-Since": last_modified}
+    )
+    assert response.status_code == 304
+
+    await create_comment(
+        "Test Comment", created_post["id"], async_client, logged_in_token
+    )
+    response = await async_client.get(
+        f"/post/{created_post['id']}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_schema_documented(async_client: AsyncClient):
+    """Test that the fast serialization path keeps the documented schema."""
+    response = await async_client.get("/openapi.json")
+    content = response.json()["paths"]["/posts"]["get"]["responses"]["200"]["content"]
+    schema = content["application/json"]["schema"]
+    assert schema["items"]["$ref"].endswith("/UserPostWithLikes")
+
+
+@pytest.fixture()
+async def replica(tmp_path, mocker):
+    """Stands in a second SQLite file for the read replica."""
+    replica = Database(f"sqlite:///{tmp_path / 'replica.db'}")
+    await replica.connect()
+    await upgrade(replica)
+    mocker.patch("app.routers.post.read_database", replica)
+    yield replica
+    await replica.disconnect()
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_from_replica(async_client: AsyncClient, replica: Database):
+    """Test that the feed is read from the replica."""
+    await replica.execute(user_table.insert().values(id=1, email="r@example.com"))
+    await replica.execute(post_table.insert().values(body="On replica", user_id=1))
+
+    response = await async_client.get("/posts")
+
+    assert ["On replica"] == [post["body"] for post in response.json()]
+    response = await async_client.get("/post/1")
+    assert "On replica" == response.json()["post"]["body"]
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_reads_own_writes(
+    async_client: AsyncClient, logged_in_token: str, replica: Database, mocker
+):
+    """Test that a feed just changed is read from the primary until the lag passed."""
+    await create_post("On primary", async_client, logged_in_token)
+
+    response = await async_client.get("/posts")
+    assert ["On primary"] == [post["body"] for post in response.json()]
+
+    post_cache.clear()
+    later = time.time() + config.READ_REPLICA_MAX_LAG_SECONDS + 1
+    mocker.patch("app.routers.post.time.time", return_value=later)
+    response = await async_client.get("/posts")
+    assert [] == response.json()
@@ -1,4 +1,6 @@
 import pytest
+from app import security
+from app.config import config
 from fastapi import BackgroundTasks
 from httpx import AsyncClient
 
@@ -84,6 +86,41 @@ async def test_login_user(async_client: AsyncClient, confirmed_user: dict):
     assert "access_token" in response.json()
 
 
+@pytest.mark.anyio
+async def test_login_user_saturated(
+    async_client: AsyncClient, confirmed_user: dict, mocker
+):
+    """Test that logins are turned away while the password pool is saturated."""
+    mocker.patch.object(config, "PASSWORD_HASH_MAX_PENDING", 0)
+    response = await async_client.post(
+        "/token",
+        data={
+            "username": confirmed_user["email"],
+            "password": confirmed_user["password"],
+        },
+    )
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+
+
+@pytest.mark.anyio
+async def test_login_user_rate_limited(
+    async_client: AsyncClient, confirmed_user: dict, mocker
+):
+    """Test that repeated logins are turned away before any hashing."""
+    hash_task = mocker.spy(security, "run_password_task")
+    data = {"username": confirmed_user["email"], "password": "wrong"}
+    for _ in range(config.AUTH_EMAIL_BURST):
+        await async_client.post("/token", data=data)
+    calls = hash_task.call_count
+
+    response = await async_client.post("/token", data=data)
+
+    assert response.status_code == 429
+    assert "retry-after" in response.headers
+    assert hash_task.call_count == calls
+
+
 @pytest.mark.anyio
 async def test_login_user_note_confirmed(
     async_client: AsyncClient, registered_user: dict
@@ -114,3 +151,59 @@ async def test_login_user_wrong_password(
     )
     assert response.status_code == 401
     assert "Invalid email or password." in response.json()["detail"]
+
+
+async def login(async_client: AsyncClient, user: dict) -> dict:
+    response = await async_client.post(
+        "/token", data={"username": user["email"], "password": user["password"]}
+    )
+    return response.json()
+
+
+@pytest.mark.anyio
+async def test_refresh_tokens(async_client: AsyncClient, confirmed_user: dict):
+    """Test that a refresh token gives new tokens, but only once."""
+    tokens = await login(async_client, confirmed_user)
+    body = {"refresh_token": tokens["refresh_token"]}
+
+    response = await async_client.post("/token/refresh", json=body)
+    assert response.status_code == 200
+    assert {"access_token", "refresh_token"} <= response.json().keys()
+    assert response.json()["refresh_token"] != tokens["refresh_token"]
+
+    response = await async_client.post("/token/refresh", json=body)
+    assert response.status_code == 401
+    assert "Token has been revoked" in response.json()["detail"]
+
+
+@pytest.mark.anyio
+async def test_refresh_tokens_with_access_token(
+    async_client: AsyncClient, confirmed_user: dict
+):
+    """Test that an access token can not be used as a refresh token."""
+    tokens = await login(async_client, confirmed_user)
+    response = await async_client.post(
+        "/token/refresh", json={"refresh_token": tokens["access_token"]}
+    )
+    assert response.status_code == 401
+
+
+@pytest.mark.anyio
+async def test_logout(async_client: AsyncClient, confirmed_user: dict):
+    """Test that logging out revokes the access and the refresh token."""
+    tokens = await login(async_client, confirmed_user)
+    headers = {"Authorization": f"Bearer {tokens['access_token']}"}
+
+    response = await async_client.post(
+        "/logout", json={"refresh_token": tokens["refresh_token"]}, headers=headers
+    )
+    assert response.status_code == 200
+
+    response = await async_client.post(
+        "/post", json={"body": "Test Post"}, headers=headers
+    )
+    assert response.status_code == 401
+    response = await async_client.post(
+        "/token/refresh", json={"refresh_token": tokens["refresh_token"]}
+    )
+    assert response.status_code == 401
@@ -0,0 +1,97 @@
+from app.cache import TTLCache, VersionStamps
+
+
+def test_get_set():
+    """Test that a cached value is returned and counted as a hit."""
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert {"hits": 1, "misses": 1, "hit_rate": 0.5}.items() <= cache.stats().items()
+
+
+def test_expired_entry_is_a_miss(mocker):
+    """Test that entries are not returned after their ttl."""
+    monotonic = mocker.patch("app.cache.time.monotonic", return_value=100.0)
+    cache = TTLCache(max_size=2, ttl=5)
+    cache.set("a", 1)
+    monotonic.return_value = 105.0
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_is_evicted():
+    """Test that the least recently used entry makes room for a new one."""
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_invalidate_tag():
+    """Test that invalidating a tag drops only the entries carrying it."""
+    cache = TTLCache(max_size=10, ttl=60)
+    cache.set("a", 1, tags={"post:1"})
+    cache.set("b", 2, tags={"post:1", "post:2"})
+    cache.set("c", 3, tags={"post:2"})
+    cache.invalidate_tag("post:1")
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_disabled_cache():
+    """Test that a disabled cache stores nothing."""
+    cache = TTLCache(max_size=10, ttl=60, enabled=False)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+    assert cache.stats()["misses"] == 0
+
+
+def test_version_stamp_changes_on_bump():
+    """Test that bumping a resource changes its ETag but not the others."""
+    versions = VersionStamps(max_age=60)
+    etag_a, _ = versions.stamp("a")
+    etag_b, _ = versions.stamp("b")
+    versions.bump("a")
+    assert versions.stamp("a")[0] != etag_a
+    assert versions.stamp("b")[0] == etag_b
+    assert versions.stamp("a", 1)[0] != versions.stamp("a", 2)[0]
+
+
+def test_version_stamp_rolls_over(mocker):
+    """Test that stamps change after max_age, even without a bump."""
+    now = mocker.patch("app.cache.time.time", return_value=1025.0)
+    versions = VersionStamps(max_age=30)
+    versions.bump("a")
+    etag, last_modified = versions.stamp("a")
+    assert last_modified == 1025.0
+    now.return_value = 1049.0
+    assert versions.stamp("a") == (etag, last_modified)
+    now.return_value = 1050.0
+    assert versions.stamp("a")[0] != etag
+    assert versions.stamp("a")[1] == 1050.0
+
+
+def test_version_stamp_eviction(mocker):
+    """Test that evicting a key keeps its stamp and leaves other keys alone."""
+    now = mocker.patch("app.cache.time.time", return_value=1000.0)
+    versions = VersionStamps(max_age=3600, max_size=2)
+    cold_etag, _ = versions.stamp(1)
+    versions.bump(0)
+    etag, _ = versions.stamp(0)
+    now.return_value = 1010.0
+    versions.bump(2)
+    versions.bump(4)
+    assert versions.stamp(0)[0] == etag
+    assert versions.modified_at(0) == 1000.0
+    assert versions.stamp(1)[0] == cold_etag
+    versions.bump(0)
+    versions.bump(6)
+    versions.bump(8)
+    assert versions.stamp(0)[0] != etag
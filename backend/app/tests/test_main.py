@@ -0,0 +1,18 @@
+import pytest
+from app.config import config
+from app.main import app, lifespan
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("bootstrap", [True, False])
+async def test_lifespan_bootstraps_schema(mocker, bootstrap: bool):
+    """Test that the schema is brought up to date on startup, unless turned off."""
+    mocker.patch.object(config, "DB_BOOTSTRAP_SCHEMA", bootstrap)
+    database = mocker.patch("app.main.database", new=mocker.AsyncMock())
+    mocker.patch("app.main.read_database", new=database)
+    mocker.patch("app.main.revocation_list", new=mocker.AsyncMock())
+    mocker.patch("app.main.configure_logging")
+    upgrade = mocker.patch("app.main.upgrade")
+    async with lifespan(app):
+        pass
+    assert upgrade.await_count == int(bootstrap)
@@ -0,0 +1,20 @@
+from app.metrics import Counter, Histogram, collect
+
+
+def test_histogram_buckets():
+    """Test that observations are counted in every bucket they fit in."""
+    histogram = Histogram("test_histogram_seconds", "Test", buckets=(0.1, 1.0))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    snapshot = histogram.snapshot()
+    assert snapshot["count"] == 3
+    assert snapshot["sum"] == 5.55
+    assert snapshot["buckets"] == {"0.1": 1, "1.0": 2, "+Inf": 3}
+
+
+def test_collect():
+    """Test that metrics are collected by name."""
+    counter = Counter("test_counter_total", "Test")
+    counter.inc()
+    assert collect()["test_counter_total"] == {"type": "counter", "value": 1}
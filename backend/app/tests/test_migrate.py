@@ -0,0 +1,39 @@
+import pytest
+from app import migrate
+from app.database import like_table, post_table
+from databases import Database
+
+
+@pytest.mark.anyio
+async def test_upgrade(db: Database):
+    """Tests that all migrations are applied and recorded once."""
+    latest = migrate.MIGRATIONS[-1].version
+    assert await migrate.upgrade(db) == latest
+    assert await migrate.current_version(db) == latest
+    assert await migrate.upgrade(db) == latest
+
+
+@pytest.mark.anyio
+async def test_column_exists(db: Database):
+    """Tests that columns are found in the live schema."""
+    assert await migrate.column_exists(db, "posts", "likes")
+    assert not await migrate.column_exists(db, "posts", "missing")
+
+
+@pytest.mark.anyio
+async def test_make_likes_unique(
+    db: Database, created_post: dict, confirmed_user: dict
+):
+    """Tests that repeated likes are dropped before the unique index is created."""
+    await db.execute("DROP INDEX ux_likes_post_id_user_id")
+    like = {"post_id": created_post["id"], "user_id": confirmed_user["id"]}
+    await db.execute_many(like_table.insert(), [like, like])
+    await db.execute(post_table.update().values(likes=2))
+
+    await migrate.make_likes_unique(db)
+
+    assert len(await db.fetch_all(like_table.select())) == 1
+    post = await db.fetch_one(post_table.select())
+    assert post.likes == 1
+    with pytest.raises(Exception):
+        await db.execute(like_table.insert().values(like))
@@ -0,0 +1,42 @@
+import pytest
+from app.ratelimit import AuthLimiter, TokenBuckets
+from fastapi import HTTPException
+
+
+def test_token_bucket_burst_and_refill(mocker):
+    """Test that a bucket allows a burst and then refills at its rate."""
+    monotonic = mocker.patch("app.ratelimit.time.monotonic", return_value=100.0)
+    buckets = TokenBuckets(rate=0.5, burst=2)
+    assert buckets.take("a") is None
+    assert buckets.take("a") is None
+    assert buckets.take("a") == 2.0
+    assert buckets.take("b") is None
+
+    monotonic.return_value = 102.0
+    assert buckets.take("a") is None
+
+
+def test_auth_limiter_per_email():
+    """Test that an email is limited across client IPs."""
+    limiter = AuthLimiter(
+        ip_rate=1, ip_burst=10, email_rate=0.1, email_burst=1, max_concurrent=10
+    )
+    with limiter.admit("1.1.1.1", "test@example.com"):
+        pass
+    with pytest.raises(HTTPException) as exc_info:
+        with limiter.admit("2.2.2.2", "Test@Example.com"):
+            pass
+    assert exc_info.value.status_code == 429
+    assert exc_info.value.headers["Retry-After"] == "10"
+
+
+def test_auth_limiter_concurrency_cap():
+    """Test that requests beyond the concurrency cap are turned away."""
+    limiter = AuthLimiter(
+        ip_rate=1, ip_burst=10, email_rate=1, email_burst=10, max_concurrent=1
+    )
+    with limiter.admit("1.1.1.1", "a@example.com"):
+        with pytest.raises(HTTPException):
+            with limiter.admit("2.2.2.2", "b@example.com"):
+                pass
+    assert limiter.in_flight == 0
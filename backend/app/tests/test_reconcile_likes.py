@@ -0,0 +1,40 @@
+import pytest
+from app.database import post_table
+from app.reconcile_likes import reconcile_like_counts
+from app.tests.helpers import like_post
+from databases import Database
+from httpx import AsyncClient
+
+
+@pytest.mark.anyio
+async def test_like_post_increments_counter(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str, db: Database
+):
+    """Tests that liking a post updates the denormalized counter."""
+    await like_post(created_post["id"], async_client, logged_in_token)
+    query = post_table.select().where(post_table.c.id == created_post["id"])
+    post = await db.fetch_one(query)
+    assert post.likes == 1
+
+
+@pytest.mark.anyio
+async def test_reconcile_like_counts(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str, db: Database
+):
+    """Tests that drifted like counters are set back to the real count."""
+    await like_post(created_post["id"], async_client, logged_in_token)
+    await db.execute(
+        post_table.update().where(post_table.c.id == created_post["id"]).values(likes=5)
+    )
+
+    assert await reconcile_like_counts(db) == 1
+
+    query = post_table.select().where(post_table.c.id == created_post["id"])
+    post = await db.fetch_one(query)
+    assert post.likes == 1
+
+
+@pytest.mark.anyio
+async def test_reconcile_like_counts_nothing_to_fix(created_post: dict, db: Database):
+    """Tests that correct counters are left alone."""
+    assert await reconcile_like_counts(db) == 0
@@ -0,0 +1,64 @@
+import time
+
+import pytest
+import sqlalchemy
+from app.database import revoked_token_table
+from app.revocation import BloomFilter, RevocationList
+from databases import Database
+
+
+def test_bloom_filter():
+    """Test that added items are found and others are mostly not."""
+    bloom = BloomFilter(bits=1 << 16, hashes=7)
+    for i in range(100):
+        bloom.add(f"token-{i}")
+    assert all(f"token-{i}" in bloom for i in range(100))
+    assert sum(f"other-{i}" in bloom for i in range(1000)) < 10
+
+
+@pytest.mark.anyio
+async def test_revoke(db: Database):
+    """Test that a revoked token is revoked once and then found."""
+    revocations = RevocationList(bits=1 << 16, hashes=7)
+    expires_at = int(time.time()) + 60
+    assert not await revocations.is_revoked(db, "abc")
+    assert await revocations.revoke(db, "abc", expires_at)
+    assert not await revocations.revoke(db, "abc", expires_at)
+    assert await revocations.is_revoked(db, "abc")
+
+
+@pytest.mark.anyio
+async def test_load_revocations_of_other_workers(db: Database):
+    """Test that loading picks up unexpired revocations, also ones committed late."""
+    revocations = RevocationList(bits=1 << 16, hashes=7)
+    now = int(time.time())
+    await db.execute(
+        revoked_token_table.insert().values(
+            [
+                {"id": 2, "jti": "expired", "expires_at": now - 1},
+                {"id": 3, "jti": "revoked", "expires_at": now + 60},
+            ]
+        )
+    )
+    assert await revocations.load(db) == 1
+    assert await revocations.is_revoked(db, "revoked")
+    await db.execute(
+        revoked_token_table.insert().values(id=1, jti="late", expires_at=now + 60)
+    )
+    await revocations.load(db)
+    assert await revocations.is_revoked(db, "late")
+
+
+@pytest.mark.anyio
+async def test_prune_and_rebuild(db: Database):
+    """Test that expired revocations are deleted and the filter rebuilt."""
+    revocations = RevocationList(bits=1 << 16, hashes=7)
+    now = int(time.time())
+    assert await revocations.revoke(db, "expired", now - 1)
+    assert await revocations.revoke(db, "revoked", now + 60)
+    await revocations.prune(db)
+    await revocations.rebuild(db)
+    rows = await db.fetch_all(sqlalchemy.select(revoked_token_table.c.jti))
+    assert ["revoked"] == [row.jti for row in rows]
+    assert "expired" not in revocations._bloom
+    assert await revocations.is_revoked(db, "revoked")
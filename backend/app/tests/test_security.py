@@ -1,7 +1,9 @@
 import pytest
 from app import security
 from app.config import config
-from jose import jwt
+from app.database import user_table
+from jose import ExpiredSignatureError, jwt
+from passlib.context import CryptContext
 
 
 def test_access_token_expire_minutes():
@@ -83,6 +85,37 @@ def test_get_subject_for_token_type_wrong_type():
     assert "Token is of incorrect type, expected 'access" in exc_info.value.detail
 
 
+def test_get_claims_for_token_type_cached(mocker):
+    """Test that a verified token is not decoded again."""
+    token = security.create_access_token("test@example.com")
+    decode = mocker.spy(security.jwt, "decode")
+    security.get_claims_for_token_type(token, "access")
+    claims = security.get_claims_for_token_type(token, "access")
+    assert claims["sub"] == "test@example.com"
+    assert decode.call_count == 1
+
+
+def test_get_claims_for_token_type_cached_per_type():
+    """Test that a cached token is still rejected for another type."""
+    token = security.create_access_token("test@example.com")
+    security.get_claims_for_token_type(token, "access")
+    with pytest.raises(security.HTTPException) as exc_info:
+        security.get_claims_for_token_type(token, "confirmation")
+    assert "Token is of incorrect type" in exc_info.value.detail
+
+
+def test_get_claims_for_token_type_cached_until_expiry(mocker):
+    """Test that a cached token is verified again once it has expired."""
+    monotonic = mocker.patch("app.cache.time.monotonic", return_value=100.0)
+    token = security.create_access_token("test@example.com")
+    security.get_claims_for_token_type(token, "access")
+    monotonic.return_value = 100.0 + security.access_token_expire_minutes() * 60
+    mocker.patch.object(security.jwt, "decode", side_effect=ExpiredSignatureError)
+    with pytest.raises(security.HTTPException) as exc_info:
+        security.get_claims_for_token_type(token, "access")
+    assert "Token has expired" in exc_info.value.detail
+
+
 def test_password_hashing():
     """Test that we can hash a password."""
     password = "1234"
@@ -91,6 +124,27 @@ def test_password_hashing():
     assert password != hashed_password
 
 
+@pytest.mark.anyio
+async def test_run_password_task():
+    """Test that password hashing runs on the pool and its wait is measured."""
+    count = security.password_queue_wait.count
+    hashed_password = await security.run_password_task(
+        security.get_password_hash, "1234"
+    )
+    assert security.verify_password("1234", hashed_password)
+    assert security.password_queue_wait.count == count + 1
+    assert security.pending_password_tasks == 0
+
+
+@pytest.mark.anyio
+async def test_run_password_task_saturated(mocker):
+    """Test that password tasks are rejected when too many are pending."""
+    mocker.patch.object(config, "PASSWORD_HASH_MAX_PENDING", 0)
+    with pytest.raises(security.HTTPException) as exc_info:
+        await security.run_password_task(security.get_password_hash, "1234")
+    assert exc_info.value.status_code == 503
+
+
 @pytest.mark.anyio
 async def test_get_user(registered_user: dict):
     """Test that we can get a user from the database."""
@@ -114,6 +168,31 @@ async def test_authenticate_user(confirmed_user: dict):
     assert user.email == confirmed_user["email"]
 
 
+@pytest.mark.anyio
+async def test_authenticate_user_upgrades_hash(confirmed_user: dict, db):
+    """Test that a hash with outdated parameters is replaced on login."""
+    old_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=5)
+    query = (
+        user_table.update()
+        .where(user_table.c.email == confirmed_user["email"])
+        .values(password=old_context.hash(confirmed_user["password"]))
+    )
+    await db.execute(query)
+
+    await security.authenticate_user(
+        confirmed_user["email"], confirmed_user["password"]
+    )
+
+    user = await security.get_user(confirmed_user["email"])
+    assert not security.pwd_context.needs_update(user.password)
+    assert security.verify_password(confirmed_user["password"], user.password)
+
+
+def test_calibrate_bcrypt_rounds():
+    """Test that calibration falls back to the lowest cost for a tiny target."""
+    assert security.calibrate_bcrypt_rounds(0) == 4
+
+
 @pytest.mark.anyio
 async def test_authenticate_user_not_found():
     """Test that we cannot authenticate a nonexisting user."""
@@ -136,6 +215,22 @@ async def test_get_current_user(registered_user: dict):
     assert user.email == registered_user["email"]
 
 
+@pytest.mark.anyio
+async def test_get_current_user_cached(registered_user: dict, mocker):
+    """Test that the current user is looked up once and then cached."""
+    token = security.create_access_token(registered_user["email"])
+    get_user = mocker.spy(security, "get_user")
+    await security.get_current_user(token)
+    user = await security.get_current_user(token)
+    assert user.email == registered_user["email"]
+    assert get_user.call_count == 1
+    assert security.user_cache.stats()["hits"] >= 1
+
+    security.user_changed(registered_user["email"])
+    await security.get_current_user(token)
+    assert get_user.call_count == 2
+
+
 @pytest.mark.anyio
 async def test_get_current_user_invalid_token():
     """Test that we cannot get a user with an invalid token."""
@@ -150,3 +245,31 @@ async def test_get_current_user_wrong_type_token(registered_user: dict):
 
     with pytest.raises(security.HTTPException):
         await security.get_current_user(token)
+
+
+@pytest.mark.anyio
+async def test_get_token_user_stateless(mocker):
+    """Test that a stateless token gives the user without the database."""
+    mocker.patch.object(config, "STATELESS_AUTH", True)
+    token = security.create_access_token("test@example.com", 7, True)
+    user = await security.get_token_user(token)
+    assert (user.id, user.email) == (7, "test@example.com")
+
+
+@pytest.mark.anyio
+async def test_get_token_user_stateless_not_confirmed(mocker):
+    """Test that a stateless token of an unconfirmed user is rejected."""
+    mocker.patch.object(config, "STATELESS_AUTH", True)
+    token = security.create_access_token("test@example.com", 7, False)
+    with pytest.raises(security.HTTPException) as exc_info:
+        await security.get_token_user(token)
+    assert "Email not confirmed." in exc_info.value.detail
+
+
+@pytest.mark.anyio
+async def test_get_token_user_falls_back_to_database(registered_user: dict):
+    """Test that a token without a uid claim is resolved from the database."""
+    token = security.create_access_token(registered_user["email"], 7, True)
+    assert "uid" not in jwt.get_unverified_claims(token)
+    user = await security.get_token_user(token)
+    assert user.id == registered_user["id"]
@@ -0,0 +1,38 @@
+"""Measures the cold start of a worker: importing the app in a fresh
+interpreter, as uvicorn does for every worker process. Run from the
+backend directory:
+
+    python -m benchmarks.cold_start [--runs 10]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+def import_time() -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", "import app.main"], check=True, env=os.environ.copy()
+    )
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    import_time()  # warms the file system cache and the bytecode
+    times = [import_time() for _ in range(args.runs)]
+    print(
+        f"import app.main: median {statistics.median(times) * 1000:.0f} ms,"
+        f" min {min(times) * 1000:.0f} ms over {args.runs} runs"
+    )
+
+
+if __name__ == "__main__":
+    main()
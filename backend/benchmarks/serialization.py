@@ -0,0 +1,59 @@
+"""Compares the cost per row of serializing a feed page.
+
+The validating path is what FastAPI does with a response_model: it builds
+a model per row, dumps it to JSON compatible data and encodes that. The
+fast path projects the rows onto the model fields and encodes them with
+orjson. Run from the backend directory:
+
+    python -m benchmarks.serialization [--rows 1000] [--repeat 50]
+"""
+
+import argparse
+import json
+import timeit
+
+import orjson
+from app.models.post import UserPostWithLikes
+from app.responses import project
+from pydantic import TypeAdapter
+
+posts_adapter = TypeAdapter(list[UserPostWithLikes])
+
+
+def make_rows(count: int) -> list[dict]:
+    return [
+        {
+            "id": i,
+            "body": f"Post number {i} with a body of a typical length.",
+            "user_id": i % 50,
+            "image_url": f"https://example.com/images/{i}.jpg" if i % 3 else None,
+            "likes": i % 17,
+        }
+        for i in range(count)
+    ]
+
+
+def validating_path(rows: list[dict]) -> bytes:
+    posts = posts_adapter.validate_python(rows)
+    return json.dumps(posts_adapter.dump_python(posts, mode="json")).encode()
+
+
+def fast_path(rows: list[dict]) -> bytes:
+    return orjson.dumps([project(row, UserPostWithLikes) for row in rows])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    assert json.loads(validating_path(rows)) == json.loads(fast_path(rows))
+    for name, path in [("validating", validating_path), ("fast", fast_path)]:
+        best = min(timeit.repeat(lambda: path(rows), number=1, repeat=args.repeat))
+        print(f"{name:>10}: {best / args.rows * 1e6:.2f} us per row")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Compares SQLite under concurrent readers and writers, with and without
+the pragmas from the config.
+
+Reader and writer threads hammer a database file for a few seconds, each
+on its own connection. With the default rollback journal, writers block
+readers and fail with "database is locked"; with WAL and a busy timeout
+they mostly don't. Run from the backend directory:
+
+    python -m benchmarks.sqlite_concurrency [--readers 8] [--writers 2]
+"""
+
+import argparse
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from app.database import sqlite_pragmas
+
+DEFAULT_PRAGMAS = ["PRAGMA journal_mode = DELETE", "PRAGMA busy_timeout = 0"]
+
+
+def run(path: Path, pragmas: list[str], readers: int, writers: int, seconds: float):
+    setup = sqlite3.connect(path)
+    setup.execute("PRAGMA journal_mode = DELETE")
+    setup.execute("CREATE TABLE posts (id INTEGER PRIMARY KEY, body TEXT)")
+    setup.executemany(
+        "INSERT INTO posts (body) VALUES (?)", [(f"Post {i}",) for i in range(1000)]
+    )
+    setup.commit()
+    setup.close()
+
+    counts = {"reads": 0, "writes": 0, "locked": 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def work(write: bool):
+        connection = sqlite3.connect(path, isolation_level=None)
+        for pragma in pragmas:
+            connection.execute(pragma)
+        done = locked = 0
+        while time.perf_counter() < deadline:
+            try:
+                if write:
+                    connection.execute("INSERT INTO posts (body) VALUES ('new')")
+                else:
+                    connection.execute(
+                        "SELECT id, body FROM posts ORDER BY id DESC LIMIT 20"
+                    ).fetchall()
+                done += 1
+            except sqlite3.OperationalError:
+                locked += 1
+        connection.close()
+        with lock:
+            counts["writes" if write else "reads"] += done
+            counts["locked"] += locked
+
+    threads = [threading.Thread(target=work, args=(False,)) for _ in range(readers)]
+    threads += [threading.Thread(target=work, args=(True,)) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {name: count / seconds for name, count in counts.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    args = parser.parse_args()
+
+    for name, pragmas in [("default", DEFAULT_PRAGMAS), ("tuned", sqlite_pragmas())]:
+        with tempfile.TemporaryDirectory() as directory:
+            rates = run(
+                Path(directory) / "bench.db",
+                pragmas,
+                args.readers,
+                args.writers,
+                args.seconds,
+            )
+        print(
+            f"{name:>8}: {rates['reads']:.0f} reads/s, {rates['writes']:.0f} writes/s,"
+            f" {rates['locked']:.0f} locked errors/s"
+        )
+
+
+if __name__ == "__main__":
+    main()